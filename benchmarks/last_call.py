@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2015, 2016, 2017 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# last call optimization benchmark: runs a tail recursive loop and reports
+# goal depth and peak memory every --sample iterations - both should stay flat
+#
+
+from __future__ import print_function
+
+import sys
+import time
+import resource
+import logging
+
+from optparse import OptionParser
+
+from zamiaprolog.logicdb import LogicMemDB
+from zamiaprolog.parser  import PrologParser
+from zamiaprolog.runtime import PrologRuntime
+
+LOOP = [ u'loop(I, N) :- I < N, sample(I), J is I + 1, loop(J, N).',
+         u'loop(N, N).' ]
+
+parser = OptionParser("usage: %prog [options]")
+
+parser.add_option ("-n", "--iterations", dest="iterations", type="int", default=1000000,
+                   help="number of iterations, default: 1000000")
+parser.add_option ("-s", "--sample", dest="sample", type="int", default=100000,
+                   help="report every n iterations, default: 100000")
+parser.add_option ("-t", "--trail", action="store_true", dest="trail",
+                   help="use trail mode")
+
+(options, args) = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO)
+
+db     = LogicMemDB()
+parser = PrologParser(db)
+rt     = PrologRuntime(db, trail=options.trail)
+
+for line in LOOP:
+    db.store('bench', parser.parse_line_clauses(line)[0])
+
+ts_start = time.time()
+
+def builtin_sample(g, rt):
+
+    i = int(rt.prolog_get_float(g.terms[g.inx].args[0], g.env, g.location))
+    if i % options.sample == 0:
+        print ("%8d iterations  depth %3d  max rss %8d kB  %6.1fs" % (i, g.get_depth(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, time.time()-ts_start))
+        sys.stdout.flush()
+    return True
+
+rt.register_builtin('sample', builtin_sample, readonly=True)
+
+solutions = rt.search(parser.parse_line_clause_body(u'loop(0, %d)' % options.iterations))
+
+print ("%8d iterations, %d solution(s) in %.1fs, max rss %d kB" % (options.iterations, len(solutions), time.time()-ts_start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
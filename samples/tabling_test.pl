@@ -0,0 +1,14 @@
+%prolog
+
+table(path/2).
+
+edge(a, b).
+edge(b, c).
+edge(c, a).
+edge(c, d).
+
+% left recursive, loops forever without tabling
+
+path(X, Y) :- path(X, Z), edge(Z, Y).
+path(X, Y) :- edge(X, Y).
+
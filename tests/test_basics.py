@@ -260,6 +260,28 @@ class TestZamiaProlog (unittest.TestCase):
         self.assertEqual (solutions[2]['R'].s, "many")
         self.assertEqual (solutions[3]['R'].s, "many")
 
+    def test_cut_barrier(self):
+
+        self.parser.compile_file('samples/cut_test.pl', UNITTEST_MODULE)
+
+        for line in [u'first_number(X) :- numbers(X), !.',
+                     u'cut_or(X) :- numbers(X), ! ; X is 9.',
+                     u'cut_not(X) :- numbers(X), not(numbers(Y), !, Y is 2).',
+                     u'cnt(N, N) :- !.',
+                     u'cnt(I, N) :- J is I + 1, cnt(J, N).']:
+            self.db.store(UNITTEST_MODULE, self.parser.parse_line_clauses(line)[0])
+
+        for q, cnt in [(u'first_number(X)',         1),   # prunes choicepoints of goals before the cut
+                       (u'first_number(X), foo(R, X)', 1),
+                       (u'cut_or(X)',               1),   # or/2 is transparent to cut
+                       (u'cut_not(X)',              4),   # not/1 is opaque to cut
+                       (u'numbers(X), !',           1),   # top-level cut
+                       (u'numbers(X), cnt(0, 3)',   4)]:  # recursive predicate cutting itself
+
+            solutions = self.rt.search(self.parser.parse_line_clause_body(q))
+            logging.debug('%s: %s' % (q, repr(solutions)))
+            self.assertEqual (len(solutions), cnt)
+
     # @unittest.skip("temporarily disabled")
     def test_anon_var(self):
 
@@ -292,6 +314,178 @@ class TestZamiaProlog (unittest.TestCase):
         self.assertEqual (len(solutions), 1)
         self.assertEqual (solutions[0]['X'].f, 23.0)
 
+    def test_trail_mode(self):
+
+        self.parser.compile_file('samples/kb1.pl', UNITTEST_MODULE)
+        self.parser.compile_file('samples/or_test.pl', UNITTEST_MODULE)
+        self.parser.compile_file('samples/cut_test.pl', UNITTEST_MODULE)
+
+        rt_trail = PrologRuntime(self.db, trail=True)
+
+        for q in [u'woman(X)',
+                  u'human(X)',
+                  u'bar(R, X)',
+                  u'S is "a", or(str_append(S, "b"), str_append(S, "c"))',
+                  u'X is 42; X is 23',
+                  u'S is "a", not(woman(S)), between(1, 3, N)',
+                  u'list_findall(W, woman(W), L), length(L, N)',
+                  u'assertz(mem(a)), assertz(mem(b)), mem(X), retract(mem(a)), not(mem(a))',
+                  u'C is foo, assertz(mem(foo, bar)), if var(C:mem|bar) then C:mem|bar := 23 endif, X := C:mem|bar']:
+
+            clause = self.parser.parse_line_clause_body(q)
+
+            solutions = self.rt.search(clause)
+            solutions_trail = rt_trail.search(clause)
+
+            self.assertEqual (len(solutions_trail), len(solutions))
+            for s1, s2 in zip(solutions, solutions_trail):
+                self.assertEqual (sorted(s1), sorted(s2))
+                for k in s1:
+                    self.assertEqual (unicode(s1[k]), unicode(s2[k]))
+
+    def test_search_iter(self):
+
+        self.parser.compile_file('samples/kb1.pl', UNITTEST_MODULE)
+
+        clause = self.parser.parse_line_clause_body('woman(X)')
+        solutions = self.rt.search(clause)
+        self.assertEqual (list(map(lambda s: s['X'].name, self.rt.search_iter(clause))), list(map(lambda s: s['X'].name, solutions)))
+        self.assertEqual (len(self.rt.search(clause, limit=2)), 2)
+        self.assertEqual (len(self.rt.search_predicate('woman', ['X'], limit=1)), 1)
+        self.assertEqual (len(self.rt.search_predicate('woman', ['X'], limit=10)), 3)
+
+        # infinite search trees are fine as long as we only ask for a limited number of solutions
+
+        self.db.store(UNITTEST_MODULE, self.parser.parse_line_clauses('nat(0).')[0])
+        self.db.store(UNITTEST_MODULE, self.parser.parse_line_clauses('nat(X) :- nat(Y), X is Y + 1.')[0])
+
+        solutions = self.rt.search_predicate('nat', ['X'], limit=5)
+        self.assertEqual (list(map(lambda s: s['X'].f, solutions)), [0, 1, 2, 3, 4])
+
+        it = self.rt.search_iter(self.parser.parse_line_clause_body('nat(X), X > 2'))
+        self.assertEqual (next(it)['X'].f, 3)
+        self.assertEqual (next(it)['X'].f, 4)
+        it.close()
+
+    def test_head_matchers(self):
+
+        for line in [u'h(a, 1, "s", X, X, f(X), _, [X, b]).',
+                     u'h(b, 2, "t", Y, Z, g, Y, []).',
+                     u'h(A, B, C, D, E, F, G, H) :- A is c, B is 3.']:
+            self.db.store(UNITTEST_MODULE, self.parser.parse_line_clauses(line)[0])
+
+        clauses = self.db.lookup('h', 8)
+        self.assertEqual (len(list(filter(lambda c: c.matcher is not None, clauses))), 3)
+
+        queries = [u'h(A, B, C, D, E, F, G, H)',
+                   u'h(a, B, C, D, E, F, G, H)',
+                   u'h(A, 2, "t", D, E, F, G, H)',
+                   u'h(A, B, C, x, x, F, G, H)',
+                   u'h(A, B, C, x, y, F, G, H)',
+                   u'h(A, B, C, D, E, f(z), G, H)',
+                   u'h(A, B, C, D, E, g, G, H)',
+                   u'h(A, B, C, D, E, F, G, [q, b])',
+                   u'X is 1, h(A, X, C, D, E, F, G, H)',
+                   u'X is b, Y is "t", h(X, B, Y, D, E, F, G, H)',
+                   u'h(A, "a", C, D, E, F, G, H)',
+                   u'h(_, _, _, q, _, _, _, _)']
+
+        results = []
+        for q in queries:
+            results.append(self.rt.search(self.parser.parse_line_clause_body(q)))
+
+        # generic unification gives the same results
+
+        for clause in clauses:
+            clause.matcher = None
+
+        for q, solutions in zip(queries, results):
+            solutions2 = self.rt.search(self.parser.parse_line_clause_body(q))
+            self.assertEqual (len(solutions), len(solutions2))
+            for s1, s2 in zip(solutions, solutions2):
+                self.assertEqual (sorted(s1), sorted(s2))
+                for k in s1:
+                    self.assertEqual (unicode(s1[k]), unicode(s2[k]))
+
+        self.assertEqual (list(map(len, results)), [3, 1, 1, 3, 2, 2, 2, 1, 1, 1, 0, 3])
+
+    def test_last_call(self):
+
+        self.parser.compile_file('samples/cut_test.pl', UNITTEST_MODULE)
+
+        for line in [u'count(I, N) :- I < N, count_depth, J is I + 1, count(J, N).',
+                     u'count(N, N).',
+                     u'fill(I, N) :- I < N, assertz(filled(I)), J is I + 1, fill(J, N).',
+                     u'fill(N, N).',
+                     u'acc(N, N, A, A).',
+                     u'acc(I, N, A, R) :- I < N, A1 is A + I, J is I + 1, acc(J, N, A1, R).',
+                     u'twice(a).',
+                     u'twice(a).',
+                     u'call_twice :- twice(a).']:
+            self.db.store(UNITTEST_MODULE, self.parser.parse_line_clauses(line)[0])
+
+        depths = []
+        def builtin_count_depth(g, rt):
+            depths.append(g.get_depth())
+            return True
+
+        for rt in [self.rt, PrologRuntime(self.db, trail=True)]:
+
+            rt.register_builtin('count_depth', builtin_count_depth)
+
+            # tail recursion does not grow the goal chain
+
+            del depths[:]
+            solutions = rt.search(self.parser.parse_line_clause_body(u'count(0, 100)'))
+            self.assertEqual (len(solutions), 1)
+            self.assertEqual (len(depths), 100)
+            self.assertEqual (min(depths), max(depths))
+
+            del depths[:]
+            solutions = rt.search(self.parser.parse_line_clause_body(u'count(0, 100), X is 42'))
+            self.assertEqual (len(solutions), 1)
+            self.assertEqual (solutions[0]['X'].f, 42.0)
+            self.assertEqual (min(depths), max(depths))
+
+            # overlay is passed on to the continuation
+
+            solutions = rt.search(self.parser.parse_line_clause_body(u'fill(0, 3), filled(X)'))
+            self.assertEqual (len(solutions), 3)
+
+            for q, cnt in [(u'acc(0, 4, 0, R), R is 6',      1),   # not ground, no last call
+                           (u'not(call_twice)',              0),
+                           (u'not(count(3, 0))',             1),
+                           (u'call_twice',                   2),
+                           (u'numbers(X), count(X, 3)',      3)]:
+                solutions = rt.search(self.parser.parse_line_clause_body(q))
+                self.assertEqual (len(solutions), cnt)
+
+    def test_last_call_overwrite(self):
+
+        # callees assigning new values to their arguments are not last call optimized
+
+        for line in [u'add_item(L, E) :- list_append(L, E).',
+                     u'bump(C) :- increment(C, 1).',
+                     u'bump_via(C) :- bump(C).',
+                     u'reset(C) :- C := 0.',
+                     u'check(C) :- C > 0, write(C).']:
+            self.db.store(UNITTEST_MODULE, self.parser.parse_line_clauses(line)[0])
+
+        for rt in [self.rt, PrologRuntime(self.db, trail=True)]:
+
+            solutions = rt.search(self.parser.parse_line_clause_body(u'L is [1,2], add_item(L, 3)'))
+            self.assertEqual (unicode(solutions[0]['L']), u'[1.0,2.0,3.0]')
+
+            for q, c in [(u'C is 1, bump(C)',     2.0),
+                         (u'C is 1, bump_via(C)', 2.0),
+                         (u'C is 1, reset(C)',    0.0),
+                         (u'C is 1, check(C)',    1.0)]:
+                solutions = rt.search(self.parser.parse_line_clause_body(q))
+                self.assertEqual (solutions[0]['C'].f, c)
+
+        self.assertTrue  (self.rt._overwrites('bump_via', None))
+        self.assertFalse (self.rt._overwrites('check', None))
+
 if __name__ == "__main__":
 
     logging.basicConfig(level=logging.DEBUG)
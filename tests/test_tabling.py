@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2017 Guenter Bartsch, Heiko Schaefer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+import logging
+
+from zamiaprolog.logicdb import LogicDB, LogicMemDB
+from zamiaprolog.parser  import PrologParser
+from zamiaprolog.runtime import PrologRuntime
+from zamiaprolog.tabling import TableStore
+from zamiaprolog.logic   import *
+from zamiaprolog.errors  import PrologError
+
+UNITTEST_MODULE = 'unittests'
+
+class TestTabling (unittest.TestCase):
+
+    def setUp(self):
+
+        #
+        # db, store
+        #
+
+        db_url = 'sqlite:///foo.db'
+
+        # setup compiler + environment
+
+        self.db     = LogicDB(db_url)
+        self.parser = PrologParser(self.db)
+        self.rt     = PrologRuntime(self.db)
+
+        self.db.clear_module(UNITTEST_MODULE)
+
+    def tearDown(self):
+        self.db.close()
+
+    def _search(self, rt, q):
+        solutions = rt.search(self.parser.parse_line_clause_body(q))
+        logging.debug('%s: %s' % (q, repr(solutions)))
+        return solutions
+
+    def _values(self, solutions, var):
+        return sorted(map(lambda s: text_type(s[var]), solutions))
+
+    def _store(self, lines):
+        for line in lines:
+            self.db.store(UNITTEST_MODULE, self.parser.parse_line_clauses(line)[0])
+
+    # @unittest.skip("temporarily disabled")
+    def test_directive(self):
+
+        self.parser.compile_file('samples/tabling_test.pl', UNITTEST_MODULE)
+
+        self.assertTrue (self.db.is_tabled('path', 2))
+        self.assertFalse (self.db.is_tabled('path', 3))
+        self.assertFalse (self.db.is_tabled('edge', 2))
+
+        self.db.set_tabled(UNITTEST_MODULE, 'foo', 1)
+        self.assertTrue (self.db.is_tabled('foo', 1))
+
+        with self.assertRaises(PrologError):
+            self.parser.parse_line_clauses(u'table(foo).')
+
+        self.db.clear_module(UNITTEST_MODULE)
+        self.assertFalse (self.db.is_tabled('path', 2))
+
+    # @unittest.skip("temporarily disabled")
+    def test_left_recursion(self):
+
+        self.parser.compile_file('samples/tabling_test.pl', UNITTEST_MODULE)
+
+        for rt in [self.rt, PrologRuntime(self.db, trail=True), PrologRuntime(self.db, tables=False)]:
+
+            self.assertEqual (self._values(self._search(rt, u'path(a, X)'), 'X'), [u'a', u'b', u'c', u'd'])
+            self.assertEqual (len(self._search(rt, u'path(X, Y)')), 12)
+            self.assertEqual (self._values(self._search(rt, u'path(X, a)'), 'X'), [u'a', u'b', u'c'])
+            self.assertEqual (len(self._search(rt, u'path(d, X)')), 0)
+            self.assertEqual (len(self._search(rt, u'path(a, d)')), 1)
+            self.assertEqual (len(self._search(rt, u'path(a, X), path(X, a)')), 3)
+
+    # @unittest.skip("temporarily disabled")
+    def test_recursion(self):
+
+        self.parser.compile_file('samples/tabling_test.pl', UNITTEST_MODULE)
+
+        self._store([u'rpath(X, Y) :- edge(X, Z), rpath(Z, Y).',
+                     u'rpath(X, Y) :- edge(X, Y).',
+                     u'succ(0, 1).',
+                     u'succ(1, 2).',
+                     u'succ(2, 3).',
+                     u'succ(3, 4).',
+                     u'even(0).',
+                     u'even(Y) :- odd(X), succ(X, Y).',
+                     u'odd(Y) :- even(X), succ(X, Y).'])
+        for name, arity in [('rpath', 2), ('even', 1), ('odd', 1)]:
+            self.db.set_tabled(UNITTEST_MODULE, name, arity)
+
+        # right recursion over a cycle, mutual recursion
+
+        self.assertEqual (self._values(self._search(self.rt, u'rpath(a, X)'), 'X'), [u'a', u'b', u'c', u'd'])
+        self.assertEqual (len(self._search(self.rt, u'rpath(X, Y)')), 12)
+        self.assertEqual (len(self._search(self.rt, u'even(X)')), 3)
+        self.assertEqual (len(self._search(self.rt, u'odd(X)')), 2)
+        self.assertEqual (len(self._search(self.rt, u'even(3)')), 0)
+        self.assertEqual (len(self._search(self.rt, u'even(4)')), 1)
+
+    # @unittest.skip("temporarily disabled")
+    def test_reuse_and_invalidation(self):
+
+        self.parser.compile_file('samples/tabling_test.pl', UNITTEST_MODULE)
+
+        self.assertEqual (len(self._search(self.rt, u'path(a, X)')), 4)
+        self.rt.tables.reset_stats()
+        self.assertEqual (len(self._search(self.rt, u'path(a, X)')), 4)
+        self.assertEqual (self.rt.tables.get_stats()['hits'], 1)
+        self.assertEqual (self.rt.tables.get_stats()['misses'], 0)
+
+        # store invalidates tables depending on the predicate
+
+        self._store([u'edge(d, e).'])
+        self.assertEqual (self._values(self._search(self.rt, u'path(a, X)'), 'X'), [u'a', u'b', u'c', u'd', u'e'])
+        self.assertEqual (self.rt.tables.get_stats()['invalidations'], 1)
+
+        # overlays modifying a predicate the table depends on lead to a separate table,
+        # others do not
+
+        self.assertEqual (self._values(self._search(self.rt, u'assertz(edge(e, f)), path(a, X)'), 'X'), [u'a', u'b', u'c', u'd', u'e', u'f'])
+        self.assertEqual (len(self._search(self.rt, u'retract(edge(c, d)), path(a, X)')), 3)
+
+        self.rt.tables.reset_stats()
+        self.assertEqual (len(self._search(self.rt, u'assertz(foo(bar)), path(a, X)')), 5)
+        self.assertEqual (self.rt.tables.get_stats()['misses'], 0)
+
+        self.assertEqual (len(self._search(self.rt, u'path(a, X)')), 5)
+
+        # recompiling the source file drops its table directives
+
+        self.db.clear_file(UNITTEST_MODULE, 'samples/tabling_test.pl')
+        self.assertFalse (self.db.is_tabled('path', 2))
+        self.assertEqual (len(self._search(self.rt, u'path(a, X)')), 0)
+
+    # @unittest.skip("temporarily disabled")
+    def test_eviction(self):
+
+        self.parser.compile_file('samples/tabling_test.pl', UNITTEST_MODULE)
+
+        rt = PrologRuntime(self.db, tables=TableStore(max_tables=2))
+
+        for n in [u'a', u'b', u'c', u'd']:
+            self._search(rt, u'path(%s, X)' % n)
+
+        self.assertTrue (len(rt.tables) <= 2)
+        self.assertTrue (rt.tables.get_stats()['evictions'] > 0)
+        self.assertEqual (len(self._search(rt, u'path(a, X)')), 4)
+
+        rt = PrologRuntime(self.db, tables=TableStore(max_answers=5))
+        self._search(rt, u'path(a, X)')
+        self._search(rt, u'path(b, X)')
+        self.assertEqual (len(rt.tables), 1)
+        self.assertEqual (rt.tables.get_stats()['answers'], 4)
+
+    # @unittest.skip("temporarily disabled")
+    def test_memdb(self):
+
+        db     = LogicMemDB()
+        parser = PrologParser(db)
+        rt     = PrologRuntime(db)
+
+        parser.compile_file('samples/tabling_test.pl', UNITTEST_MODULE)
+        self.assertTrue (db.is_tabled('path', 2))
+
+        self.assertEqual (len(rt.search(parser.parse_line_clause_body(u'path(a, X)'))), 4)
+
+        db.store(UNITTEST_MODULE, parser.parse_line_clauses(u'edge(d, e).')[0])
+        self.assertEqual (len(rt.search(parser.parse_line_clause_body(u'path(a, X)'))), 5)
+
+        db.clear_module(UNITTEST_MODULE)
+        self.assertFalse (db.is_tabled('path', 2))
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+    logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
+
+    unittest.main()
+
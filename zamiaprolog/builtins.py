@@ -31,8 +31,6 @@ import copy
 
 from tzlocal import get_localzone # $ pip install tzlocal
 
-from zamiaprolog         import model
-
 from zamiaprolog.logic   import *
 from zamiaprolog.logicdb import LogicDBOverlay
 from zamiaprolog.errors  import *
@@ -952,18 +950,7 @@ def builtin_setz(g, rt):
     return [env]
 
 def do_gensym(rt, root):
-
-    orm_gn = rt.db.session.query(model.ORMGensymNum).filter(model.ORMGensymNum.root==root).first()
-
-    if not orm_gn:
-        current_num = 1
-        orm_gn = model.ORMGensymNum(root=root, current_num=1)
-        rt.db.session.add(orm_gn)
-    else:
-        current_num = orm_gn.current_num + 1
-        orm_gn.current_num = current_num
-
-    return root + str(current_num)
+    return rt.db.gensym(root)
 
 def builtin_gensym(g, rt):
 
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2015, 2016, 2017 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# bounded clause cache used by LogicDB (and, via TableStore, by tabling)
+#
+# entries are keyed by predicate name. Lookups do not modify the cache
+# structure (they just stamp the entry), eviction happens on insert once
+# the configured entry count, clause count or byte limits are exceeded and
+# removes entries until the cache is below CACHE_LOW_WATERMARK of its limits.
+#
+# get(), peek(), hit() and miss() are safe to call from several threads
+# without locking (statistics may be slightly off), put/invalidate/clear
+# have to be serialized by the caller.
+#
+
+import logging
+import heapq
+
+from zamiaprolog.logic  import *
+from zamiaprolog.errors import PrologError
+
+CACHE_POLICY_LRU    = 'lru'
+CACHE_POLICY_LFU    = 'lfu'
+
+CACHE_LOW_WATERMARK = 0.9
+
+# rough per-object sizes (bytes) used by estimate_size()
+
+_SIZE_OBJECT = 64
+_SIZE_REF    = 8
+
+def estimate_size(o):
+
+    """ rough estimate of the memory footprint of a prolog term or clause """
+
+    if o is None:
+        return 0
+
+    if isinstance(o, Predicate):
+        res = 2 * _SIZE_OBJECT + len(o.name) + _SIZE_REF * len(o.args)
+        for a in o.args:
+            res += estimate_size(a)
+        return res
+
+    if isinstance(o, Variable):
+        return 2 * _SIZE_OBJECT + len(o.name)
+
+    if isinstance(o, StringLiteral):
+        return 2 * _SIZE_OBJECT + len(o.s)
+
+    if isinstance(o, NumberLiteral):
+        return 2 * _SIZE_OBJECT
+
+    if isinstance(o, ListLiteral):
+        res = 2 * _SIZE_OBJECT + _SIZE_REF * len(o.l)
+        for a in o.l:
+            res += estimate_size(a)
+        return res
+
+    if isinstance(o, Clause):
+        return _SIZE_OBJECT + estimate_size(o.head) + estimate_size(o.body) + estimate_size(o.location)
+
+    return 2 * _SIZE_OBJECT
+
+class _CacheEntry(object):
+
+    __slots__ = ('value', 'clauses', 'nbytes', 'tick', 'freq')
+
+    def __init__(self, value, clauses, nbytes, tick):
+        self.value   = value
+        self.clauses = clauses
+        self.nbytes  = nbytes
+        self.tick    = tick
+        self.freq    = 0
+
+class ClauseCache(object):
+
+    """ size-aware clause cache with LRU or LFU eviction.
+
+        max_clauses / max_bytes: limits on the total number of cached clauses
+        and their estimated size, max_entries on the number of entries.
+        None disables the respective limit """
+
+    def __init__(self, policy=CACHE_POLICY_LRU, max_clauses=None, max_bytes=None, max_entries=None):
+
+        if not policy in (CACHE_POLICY_LRU, CACHE_POLICY_LFU):
+            raise PrologError ('unknown cache policy: %s' % policy)
+
+        self.policy      = policy
+        self.max_clauses = max_clauses
+        self.max_bytes   = max_bytes
+        self.max_entries = max_entries
+
+        self.entries     = {}
+        self.tick        = 0
+        self.clauses     = 0
+        self.nbytes      = 0
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits          = 0
+        self.misses        = 0
+        self.evictions     = 0
+        self.invalidations = 0
+
+    def get_stats(self):
+        return {'hits'         : self.hits,
+                'misses'       : self.misses,
+                'evictions'    : self.evictions,
+                'invalidations': self.invalidations,
+                'entries'      : len(self.entries),
+                'clauses'      : self.clauses,
+                'bytes'        : self.nbytes}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def get(self, name):
+
+        e = self.entries.get(name)
+        if e is None:
+            self.miss()
+            return None
+
+        self.hit(name)
+
+        return e.value
+
+    def peek(self, name):
+
+        """ like get() but does not count as a hit or miss """
+
+        e = self.entries.get(name)
+        if e is None:
+            return None
+        return e.value
+
+    def hit(self, name):
+
+        """ count a hit on name - for callers which peek() first since a cached
+            value may not be able to answer every query """
+
+        self.hits += 1
+
+        e = self.entries.get(name)
+        if e is None:
+            return
+        self.tick += 1
+        e.tick     = self.tick
+        e.freq    += 1
+
+    def miss(self):
+        self.misses += 1
+
+    def put(self, name, value, clauses, nbytes):
+
+        old = self.entries.get(name)
+        if old:
+            self.clauses -= old.clauses
+            self.nbytes  -= old.nbytes
+
+        self.tick += 1
+        e = _CacheEntry(value, clauses, nbytes, self.tick)
+        if old:
+            e.freq = old.freq
+        self.entries[name] = e
+
+        self.clauses += clauses
+        self.nbytes  += nbytes
+
+        if self._over_limit(1.0):
+            self._evict(keep=name)
+
+    def _over_limit(self, f):
+        if self.max_entries is not None and len(self.entries) > self.max_entries * f:
+            return True
+        if self.max_clauses is not None and self.clauses > self.max_clauses * f:
+            return True
+        if self.max_bytes is not None and self.nbytes > self.max_bytes * f:
+            return True
+        return False
+
+    def _evict(self, keep):
+
+        # ticks are unique, so names are never compared
+
+        if self.policy == CACHE_POLICY_LFU:
+            victims = [(e.freq, e.tick, name) for name, e in self.entries.items()]
+        else:
+            victims = [(e.tick, name) for name, e in self.entries.items()]
+        heapq.heapify(victims)
+
+        while victims and self._over_limit(CACHE_LOW_WATERMARK):
+            name = heapq.heappop(victims)[-1]
+            if name == keep:
+                continue
+            self._remove(name)
+            self.evictions += 1
+
+        if self._over_limit(1.0):
+            logging.debug ('%s: %s alone exceeds cache limits.' % (self.__class__.__name__, repr(keep)))
+
+    def _remove(self, name):
+        e = self.entries.pop(name)
+        self.clauses -= e.clauses
+        self.nbytes  -= e.nbytes
+
+    def invalidate(self, name):
+        if name in self.entries:
+            self._remove(name)
+            self.invalidations += 1
+            return 1
+        return 0
+
+    def clear(self):
+        n = len(self.entries)
+        self.invalidations += n
+        self.entries = {}
+        self.clauses = 0
+        self.nbytes  = 0
+        return n
+
@@ -23,8 +23,9 @@
 
 import logging
 import json
+import struct
 
-from six                import python_2_unicode_compatible, text_type, string_types
+from six                import python_2_unicode_compatible, text_type, string_types, integer_types
 
 from zamiaprolog.errors import PrologError
 
@@ -369,6 +370,9 @@ def build_predicate(name, args):
 @python_2_unicode_compatible
 class Clause(JSONLogic):
 
+    # compiled head matcher (see matcher.compile_head), set when LogicDB caches the clause
+    matcher = None
+
     def __init__(self, head=None, body=None, location=None, json_dict=None):
         if json_dict:
             self.head     = json_dict['head'] 
@@ -482,3 +486,281 @@ def _prolog_from_json(o):
 def json_to_prolog(jstr):
     return json.JSONDecoder(object_hook = _prolog_from_json).decode(jstr)
 
+#
+# compact binary interface
+#
+# format: magic 'ZPB', version byte, string table, term tree
+#
+# string table: varint count followed by (varint length, utf-8 bytes) entries
+# term tree:    one tag byte per node followed by the node's fields, strings
+#               are stored as varint indices into the string table,
+#               optional strings/ints are stored shifted by one (0 == None)
+#
+
+PROLOG_BIN_MAGIC   = bytearray(b'ZPB')
+PROLOG_BIN_VERSION = 1
+
+_BIN_NONE      =  0
+_BIN_CLAUSE    =  1
+_BIN_PREDICATE =  2
+_BIN_ATOM      =  3
+_BIN_VARIABLE  =  4
+_BIN_STRING    =  5
+_BIN_INT       =  6
+_BIN_FLOAT     =  7
+_BIN_LIST      =  8
+_BIN_DICT      =  9
+_BIN_SET       = 10
+_BIN_LOCATION  = 11
+_BIN_MACROCALL = 12
+
+_bin_double = struct.Struct('>d')
+
+def _bin_write_varint(buf, n):
+    while n > 0x7f:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+class _BinEncoder(object):
+
+    def __init__(self):
+        self.strings = {}
+        self.buf     = bytearray()
+
+    def string(self, s):
+        idx = self.strings.get(s)
+        if idx is None:
+            idx = len(self.strings)
+            self.strings[s] = idx
+        _bin_write_varint(self.buf, idx)
+
+    def opt_string(self, s):
+        if s is None:
+            self.buf.append(0)
+        else:
+            idx = self.strings.get(s)
+            if idx is None:
+                idx = len(self.strings)
+                self.strings[s] = idx
+            _bin_write_varint(self.buf, idx+1)
+
+    def opt_int(self, n):
+        _bin_write_varint(self.buf, 0 if n is None else n+1)
+
+    def encode(self, o):
+
+        buf = self.buf
+
+        if o is None:
+            buf.append(_BIN_NONE)
+
+        elif isinstance(o, Predicate):
+            if o.args:
+                buf.append(_BIN_PREDICATE)
+                self.string(o.name)
+                _bin_write_varint(buf, len(o.args))
+                for a in o.args:
+                    self.encode(a)
+            else:
+                buf.append(_BIN_ATOM)
+                self.string(o.name)
+
+        elif isinstance(o, Variable):
+            buf.append(_BIN_VARIABLE)
+            self.string(o.name)
+
+        elif isinstance(o, StringLiteral):
+            buf.append(_BIN_STRING)
+            self.string(o.s)
+
+        elif isinstance(o, NumberLiteral):
+            if isinstance(o.f, float):
+                buf.append(_BIN_FLOAT)
+                buf.extend(_bin_double.pack(o.f))
+            elif isinstance(o.f, integer_types) and not isinstance(o.f, bool):
+                buf.append(_BIN_INT)
+                _bin_write_varint(buf, (o.f << 1) if o.f >= 0 else ((-o.f << 1) - 1))
+            else:
+                raise PrologError('cannot convert to binary: %s .' % repr(o))
+
+        elif isinstance(o, ListLiteral):
+            buf.append(_BIN_LIST)
+            _bin_write_varint(buf, len(o.l))
+            for a in o.l:
+                self.encode(a)
+
+        elif isinstance(o, DictLiteral):
+            buf.append(_BIN_DICT)
+            _bin_write_varint(buf, len(o.d))
+            for k in sorted(o.d):
+                self.string(k)
+                self.encode(o.d[k])
+
+        elif isinstance(o, SetLiteral):
+            buf.append(_BIN_SET)
+            _bin_write_varint(buf, len(o.s))
+            for a in o.s:
+                self.encode(a)
+
+        elif isinstance(o, Clause):
+            buf.append(_BIN_CLAUSE)
+            self.encode(o.head)
+            self.encode(o.body)
+            self.encode(o.location)
+
+        elif isinstance(o, SourceLocation):
+            buf.append(_BIN_LOCATION)
+            self.opt_string(o.fn)
+            self.opt_int(o.line)
+            self.opt_int(o.col)
+
+        elif isinstance(o, MacroCall):
+            buf.append(_BIN_MACROCALL)
+            self.string(o.name)
+            self.string(o.pred)
+            self.encode(o.location)
+
+        else:
+            raise PrologError('cannot convert to binary: %s .' % repr(o))
+
+def prolog_to_bin(pl):
+
+    enc = _BinEncoder()
+    enc.encode(pl)
+
+    strings = sorted(enc.strings, key=lambda s: enc.strings[s])
+
+    res = bytearray(PROLOG_BIN_MAGIC)
+    res.append(PROLOG_BIN_VERSION)
+    _bin_write_varint(res, len(strings))
+    for s in strings:
+        b = s.encode('utf8') if isinstance(s, text_type) else s
+        _bin_write_varint(res, len(b))
+        res.extend(b)
+    res.extend(enc.buf)
+
+    return bytes(res)
+
+def _bin_read_varint(buf, pos):
+
+    n     = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+def _bin_decode(buf, pos, strings):
+
+    tag = buf[pos]
+    pos += 1
+
+    if tag == _BIN_ATOM:
+        b = buf[pos]
+        if b < 0x80:
+            return Predicate(strings[b]), pos+1
+        idx, pos = _bin_read_varint(buf, pos)
+        return Predicate(strings[idx]), pos
+
+    if tag == _BIN_VARIABLE:
+        b = buf[pos]
+        if b < 0x80:
+            return Variable(strings[b]), pos+1
+        idx, pos = _bin_read_varint(buf, pos)
+        return Variable(strings[idx]), pos
+
+    if tag == _BIN_PREDICATE:
+        idx, pos = _bin_read_varint(buf, pos)
+        n, pos   = _bin_read_varint(buf, pos)
+        args = []
+        for i in range(n):
+            a, pos = _bin_decode(buf, pos, strings)
+            args.append(a)
+        return Predicate(strings[idx], args), pos
+
+    if tag == _BIN_NONE:
+        return None, pos
+
+    if tag == _BIN_FLOAT:
+        return NumberLiteral(_bin_double.unpack_from(buf, pos)[0]), pos+8
+
+    if tag == _BIN_STRING:
+        idx, pos = _bin_read_varint(buf, pos)
+        return StringLiteral(strings[idx]), pos
+
+    if tag == _BIN_INT:
+        n, pos = _bin_read_varint(buf, pos)
+        return NumberLiteral((n >> 1) if not (n & 1) else -((n + 1) >> 1)), pos
+
+    if tag == _BIN_CLAUSE:
+        head, pos     = _bin_decode(buf, pos, strings)
+        body, pos     = _bin_decode(buf, pos, strings)
+        location, pos = _bin_decode(buf, pos, strings)
+        return Clause(head, body, location=location), pos
+
+    if tag == _BIN_LOCATION:
+        fn, pos   = _bin_read_varint(buf, pos)
+        line, pos = _bin_read_varint(buf, pos)
+        col, pos  = _bin_read_varint(buf, pos)
+        return SourceLocation(strings[fn-1] if fn else None, 
+                              line-1 if line else None, 
+                              col-1 if col else None), pos
+
+    if tag == _BIN_LIST:
+        n, pos = _bin_read_varint(buf, pos)
+        l = []
+        for i in range(n):
+            a, pos = _bin_decode(buf, pos, strings)
+            l.append(a)
+        return ListLiteral(l), pos
+
+    if tag == _BIN_DICT:
+        n, pos = _bin_read_varint(buf, pos)
+        d = {}
+        for i in range(n):
+            idx, pos = _bin_read_varint(buf, pos)
+            v, pos   = _bin_decode(buf, pos, strings)
+            d[strings[idx]] = v
+        return DictLiteral(d), pos
+
+    if tag == _BIN_SET:
+        n, pos = _bin_read_varint(buf, pos)
+        s = set()
+        for i in range(n):
+            a, pos = _bin_decode(buf, pos, strings)
+            s.add(a)
+        return SetLiteral(s), pos
+
+    if tag == _BIN_MACROCALL:
+        name, pos     = _bin_read_varint(buf, pos)
+        pred, pos     = _bin_read_varint(buf, pos)
+        location, pos = _bin_decode(buf, pos, strings)
+        return MacroCall(strings[name], strings[pred], location=location), pos
+
+    raise PrologError('cannot convert from binary: unknown tag %d at pos %d.' % (tag, pos-1))
+
+def bin_to_prolog(data):
+
+    buf = bytearray(data)
+
+    if buf[:3] != PROLOG_BIN_MAGIC:
+        raise PrologError('cannot convert from binary: magic missing.')
+    if buf[3] != PROLOG_BIN_VERSION:
+        raise PrologError('cannot convert from binary: unsupported version %d.' % buf[3])
+
+    n, pos = _bin_read_varint(buf, 4)
+
+    strings = []
+    for i in range(n):
+        l, pos = _bin_read_varint(buf, pos)
+        strings.append(buf[pos:pos+l].decode('utf8'))
+        pos += l
+
+    res, pos = _bin_decode(buf, pos, strings)
+
+    return res
+
@@ -25,155 +25,1664 @@ import os
 import sys
 import logging
 import time
+import heapq
+import itertools
+import threading
+import functools
+import json
+
+from copy           import deepcopy
+from sqlalchemy     import create_engine, or_, and_, select, inspect, bindparam, func, event
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.exc import IntegrityError
+from six            import python_2_unicode_compatible, text_type
+from zamiaprolog    import model
+
+from zamiaprolog.logic       import *
+from zamiaprolog.clausecache import ClauseCache, estimate_size
+from zamiaprolog.snapshot    import Snapshot, export_snapshot
+from zamiaprolog.persistent  import EMPTY_MAP, cons_to_tuple, cons_from
+from zamiaprolog.matcher     import compile_clauses
+from nltools.misc            import limit_str
+
+# number of lookups with the same set of bound argument positions
+# before a multi-column index is built for them
+COMPOSITE_INDEX_THRESHOLD = 16
+
+# default number of rows per executemany() in LogicDB.store_many
+STORE_BATCH_SIZE = 1000
+
+# number of rows fetched and decoded at a time by LogicDB.preload
+PRELOAD_BATCH_SIZE = 1000
+
+# number of gensym numbers reserved per root and db round trip
+GENSYM_BLOCK_SIZE = 100
+
+# max number of bound parameters in generated IN (...) clauses
+SQL_IN_CHUNK_SIZE = 500
+
+# rows converted per round trip when upgrading the clauses of an existing db
+UPGRADE_BATCH_SIZE = 1000
+
+# number of filtered (partial) loads of a predicate name/arity from the db
+# before all of its clauses are loaded and indexed in memory
+PARTIAL_LOAD_LIMIT = 16
+
+def _track_writes (conn, cursor, statement, parameters, context, executemany):
+    if statement.split(None, 1)[0].upper() in ('INSERT', 'UPDATE', 'DELETE', 'REPLACE'):
+        conn.info['written'] = True
+
+def _reset_writes (conn):
+    conn.info.pop('written', None)
+
+def _reset_pooled_writes (dbapi_conn, connection_record):
+    connection_record.info.pop('written', None)
+
+def _sf_matches (clause, sf):
+
+    """ check clause head against static filter (dict arg position -> constant name) """
+
+    for i in sf:
+        a = clause.head.args[i]
+        if not isinstance(a, Predicate):
+            continue
+        if (a.name != sf[i]) or (len(a.args) !=0):
+            return False
+
+    return True
+
+def _clause_matches (clause, arity, sf):
+
+    """ check clause against arity and static filter, use arity=-1 to disable filtering """
+
+    if arity<0:
+        return True
+
+    if len(clause.head.args) != arity:
+        return False
+
+    if sf:
+        return _sf_matches(clause, sf)
+
+    return True
+
+# arg index keys: constants are indexed by name, variables and literals match
+# any constant so they end up in the wildcard list. compound terms never
+# match a constant, so they are not indexed at all.
+
+_KEY_WILDCARD = 0
+_KEY_COMPOUND = 1
+
+def _arg_key (a):
+    if not isinstance(a, Predicate):
+        return _KEY_WILDCARD
+    if len(a.args) != 0:
+        return _KEY_COMPOUND
+    return a.name
+
+def _arg_functor (a):
+
+    """ value of the materialized argN column for head argument a """
+
+    if not isinstance(a, Predicate):
+        return None
+    if len(a.args) != 0:
+        return u'%s/%d' % (a.name, len(a.args))
+    return a.name
+
+def _clause_from_orm (ormc):
+
+    """ decode clause from its binary encoding if present, fall back to json otherwise """
+
+    if ormc.prolog_bin:
+        return bin_to_prolog(ormc.prolog_bin)
+
+    return json_to_prolog(ormc.prolog)
+
+def _predicate_stats (clauses, facts, distinct):
+    return {'clauses'   : clauses,
+            'facts'     : facts,
+            'rules'     : clauses - facts,
+            'fact_ratio': float(facts) / clauses if clauses else 0.0,
+            'distinct'  : distinct}
+
+def compute_stats (arity, clauses):
+
+    """ statistics for the clauses of one name/arity, see LogicDB.stats() """
+
+    cnt    = 0
+    facts  = 0
+    values = [set() for i in range(arity)]
+
+    for clause in clauses:
+        cnt += 1
+        if clause.body is None:
+            facts += 1
+        for i, a in enumerate(clause.head.args):
+            if not isinstance(a, Variable):
+                values[i].add(text_type(a))
+
+    return _predicate_stats(cnt, facts, list(map(len, values)))
+
+class _Column(object):
+
+    """ hash index on one or more argument positions. Results are memoized per key
+        as tuples so repeated lookups hand out the same shared object """
+
+    __slots__ = ('positions', 'buckets', 'wildcards', 'memo')
+
+    def __init__(self, positions, buckets, wildcards):
+        self.positions = positions    # tuple of arg positions
+        self.buckets   = buckets      # key -> list of clause idx
+        self.wildcards = wildcards    # list of clause idx matching any key
+        self.memo      = {}           # key -> tuple of clauses
+
+class ArityIndex(object):
+
+    """ clauses of one predicate name/arity plus hash indexes on constant arguments.
+        Single column indexes are built on first use, multi-column indexes once a
+        combination of bound arguments has been seen COMPOSITE_INDEX_THRESHOLD times.
+
+        clauses as well as all lookup results are tuples shared between callers,
+        they must not be modified. Results are memoized except for combinations of
+        bound arguments which do not have an index (yet). """
+
+    def __init__(self, clauses):
+
+        self.clauses  = tuple(clauses)
+        self.columns  = {}      # tuple of arg positions -> _Column
+        self.single   = {}      # arg position -> single column _Column
+        self.patterns = {}      # tuple of arg positions -> number of lookups seen
+
+    def _build_column (self, positions):
+
+        buckets   = {}
+        wildcards = []
+
+        for idx, clause in enumerate(self.clauses):
+
+            key = []
+            wild = False
+            for i in positions:
+                k = _arg_key(clause.head.args[i])
+                if k is _KEY_COMPOUND:
+                    break
+                if k is _KEY_WILDCARD:
+                    wild = True
+                key.append(k)
+            else:
+                if wild:
+                    wildcards.append(idx)
+                elif len(positions) == 1:
+                    buckets.setdefault(key[0], []).append(idx)
+                else:
+                    buckets.setdefault(tuple(key), []).append(idx)
+
+        column = _Column(positions, buckets, wildcards)
+        self.columns[positions] = column
+        if len(positions) == 1:
+            self.single[positions[0]] = column
+        return column
+
+    def _get_column (self, positions):
+        column = self.columns.get(positions)
+        if column is None:
+            column = self._build_column(positions)
+        return column
+
+    def _select (self, column, sf):
+
+        """ clauses matching sf on all of the column's positions """
+
+        positions = column.positions
+        if len(positions) == 1:
+            key = sf[positions[0]]
+        else:
+            key = tuple(map(lambda i: sf[i], positions))
+
+        res = column.memo.get(key)
+        if res is not None:
+            return res
+
+        clauses   = self.clauses
+        bucket    = column.buckets.get(key)
+        wildcards = column.wildcards
+
+        if bucket is None:
+
+            # keys not in the index are unbounded so we do not memoize them -
+            # on a single column the result is the wildcard list which is shared
+
+            if len(positions) == 1:
+                res = column.memo.get(None)
+                if res is None:
+                    res = tuple(map(lambda i: clauses[i], wildcards))
+                    column.memo[None] = res
+                return res
+
+            return tuple(filter(lambda c: _sf_matches(c, sf), map(lambda i: clauses[i], wildcards)))
+
+        # single column: wildcard entries match any key.
+        # multi column: they have to be checked for the remaining positions
+
+        if wildcards:
+            if len(positions) > 1:
+                wildcards = list(filter(lambda i: _sf_matches(clauses[i], sf), wildcards))
+            bucket = heapq.merge(bucket, wildcards)
+
+        res = tuple(map(lambda i: clauses[i], bucket))
+        column.memo[key] = res
+
+        return res
+
+    def lookup (self, sf):
+
+        if not sf:
+            return self.clauses
+
+        # single bound argument (the common case): no key to build
+
+        if len(sf) == 1:
+            for i in sf:
+                column = self.single.get(i)
+                if column is None:
+                    column = self._build_column((i,))
+                return self._select(column, sf)
+
+        positions = tuple(sorted(sf))
+
+        cnt = self.patterns.get(positions, 0) + 1
+        self.patterns[positions] = cnt
+        if cnt >= COMPOSITE_INDEX_THRESHOLD or positions in self.columns:
+            return self._select(self._get_column(positions), sf)
+
+        # pick the most selective single column index, filter on the other positions
+
+        best = None
+        for i in positions:
+            column = self.single.get(i)
+            if column is None:
+                column = self._build_column((i,))
+            bucket = column.buckets.get(sf[i])
+            n = len(column.wildcards) + (len(bucket) if bucket else 0)
+            if best is None or n < best[0]:
+                best = (n, i, column)
+            if n == 0:
+                return ()
+
+        n, i, column = best
+
+        return tuple(filter(lambda c: _sf_matches(c, sf), self._select(column, sf)))
+
+_NO_PARTIALS = {}   # shared empty result for partial1 lookups, never modified
+
+class ClauseIndex(object):
+
+    """ clauses of one predicate name loaded from the db. Depending on the lookups seen
+        so far, this holds all clauses (db order), complete ArityIndex instances for
+        some arities and/or filtered partial results for (arity, sf) combinations.
+        lookup() returns None for anything that has not been loaded yet. """
+
+    def __init__(self, name):
+
+        self.name     = name
+        self.clauses  = None
+        self.arities  = {}      # arity -> ArityIndex
+        self.partial  = {}      # (arity, sf items) -> tuple of clauses
+        self.partial1 = {}      # arity -> arg position -> value -> tuple of clauses, single bound argument
+        self.nloads   = {}      # arity -> number of partial loads
+        self.parts    = {}      # loaded part -> clauses, for cache accounting
+        self.sizes    = {}      # loaded part -> (number of clauses, estimated size), computed on demand
+
+    def _partial_key (self, arity, sf):
+        return (arity, tuple(sorted(sf.items())))
+
+    def lookup (self, arity, sf):
+
+        if arity<0:
+            return self.clauses
+
+        ai = self.arities.get(arity)
+        if ai is None:
+            if self.clauses is None:
+                if not sf:
+                    return None
+                if len(sf) == 1:
+                    for i in sf:
+                        return self.partial1.get(arity, _NO_PARTIALS).get(i, _NO_PARTIALS).get(sf[i])
+                return self.partial.get(self._partial_key(arity, sf))
+            ai = ArityIndex(filter(lambda c: len(c.head.args) == arity, self.clauses))
+            self.arities[arity] = ai
+
+        return ai.lookup(sf)
+
+    def get_partial_loads (self, arity):
+        return self.nloads.get(arity, 0)
+
+    def copy (self):
+
+        """ index to load more clauses into while lock-free readers keep using this one.
+            Loaded parts are shared, they are never modified. """
+
+        ci = ClauseIndex(self.name)
+        ci.clauses = self.clauses
+        ci.arities = dict(self.arities)
+        ci.partial = dict(self.partial)
+        ci.partial1 = {}
+        for arity, by_pos in self.partial1.items():
+            ci.partial1[arity] = dict(map(lambda item: (item[0], dict(item[1])), by_pos.items()))
+        ci.nloads  = dict(self.nloads)
+        ci.parts   = dict(self.parts)
+        ci.sizes   = dict(self.sizes)
+        return ci
+
+    def _account (self, part, clauses):
+        self.parts[part] = clauses
+
+    def set_clauses (self, clauses):
+
+        # arity indexes will be rebuilt from the complete list on demand
+        self.clauses = tuple(compile_clauses(clauses))
+        self.arities = {}
+        self.partial  = {}
+        self.partial1 = {}
+        self.parts    = {}
+        self.sizes   = {}
+        self._account(None, self.clauses)
+
+    def set_arity (self, arity, clauses):
+
+        ai = ArityIndex(compile_clauses(clauses))
+        self.arities[arity] = ai
+
+        self.partial1.pop(arity, None)
+        for key in list(self.parts):
+            if isinstance(key, tuple) and key[0] == arity:
+                self.partial.pop(key, None)
+                del self.parts[key]
+                self.sizes.pop(key, None)
+
+        self._account(arity, ai.clauses)
+        return ai
+
+    def set_partial (self, arity, sf, clauses):
+
+        key = self._partial_key(arity, sf)
+        res = tuple(compile_clauses(clauses))
+        if len(sf) == 1:
+            for i in sf:
+                self.partial1.setdefault(arity, {}).setdefault(i, {})[sf[i]] = res
+        else:
+            self.partial[key] = res
+        self.nloads[arity] = self.nloads.get(arity, 0) + 1
+        self._account(key, res)
+        return res
+
+    def get_size (self):
+
+        """ number of clauses and their estimated size in bytes, for cache accounting """
+
+        nclauses = 0
+        nbytes   = 0
+        for part in self.parts:
+            size = self.sizes.get(part)
+            if size is None:
+                clauses = self.parts[part]
+                size = (len(clauses), sum(map(estimate_size, clauses)))
+                self.sizes[part] = size
+            nclauses += size[0]
+            nbytes   += size[1]
+        return nclauses, nbytes
+
+class LogicDB(object):
+
+    def __init__(self, db_url, echo=False, cache=None, snapshot=None, coherence_interval=None, coherence_per_query=False,
+                 threadsafe=False, pool_size=None, max_overflow=None, executor=None,
+                 gensym_block_size=GENSYM_BLOCK_SIZE):
+
+        """ cache: ClauseCache instance (or compatible object) to use, defaults to an unbounded LRU cache
+            snapshot: path of a snapshot file (see export_snapshot) to read clauses from instead of the db
+
+            cross-process cache coherence (other processes writing to the same db):
+            coherence_interval: check for modified predicates on lookup, at most once every coherence_interval seconds
+            coherence_per_query: check for modified predicates once at the start of each PrologRuntime.search
+
+            multi-threaded use:
+            threadsafe: use one session per thread (scoped_session). The clause cache is shared,
+                        reads are lock-free, cache misses are loaded concurrently unless they
+                        concern the same predicate name.
+            pool_size, max_overflow: engine connection pool sizing (not supported by all dialects)
+            executor: concurrent.futures executor lookup_async() runs db queries in if
+                      threadsafe=True, defaults to the event loop's default executor
+                      (without threadsafe, db queries of lookup_async() are synchronous)
+            gensym_block_size: number of gensym numbers reserved per root at a time """
+
+        engine_args = {}
+        if pool_size is not None:
+            engine_args['pool_size'] = pool_size
+        if max_overflow is not None:
+            engine_args['max_overflow'] = max_overflow
+
+        self.engine     = create_engine(db_url, echo=echo, **engine_args)
+        self.Session    = sessionmaker(bind=self.engine)
+        self.threadsafe = threadsafe
+        if threadsafe:
+            # proxies session methods to the calling thread's session
+            self.session = scoped_session(self.Session)
+        else:
+            self.session = self.Session()
+        tables = set(inspect(self.engine).get_table_names())
+        model.Base.metadata.create_all(self.engine)
+        self._upgrade_schema(tables)
+        self.cache      = cache if cache is not None else ClauseCache()
+        self.fill_lock  = threading.RLock()
+        self.name_locks = {}        # name -> [lock serializing loads of name, number of users]
+        self.local      = threading.local()
+        self.executor   = executor
+
+        self.gensym_block_size = gensym_block_size
+        if self.engine.dialect.name == 'sqlite':
+            # _gensym_in_session() needs to know whether the session holds the write lock
+            event.listen(self.engine, 'before_cursor_execute', _track_writes)
+            event.listen(self.engine, 'commit',   _reset_writes)
+            event.listen(self.engine, 'rollback', _reset_writes)
+            event.listen(self.engine, 'reset',    _reset_pooled_writes)
+
+        # predicates modified after the snapshot was exported are read from the db again
+        self.snapshot = Snapshot(snapshot) if snapshot else None
+        self.shadowed = set()
+        if self.snapshot:
+            self._shadow_newer(self.snapshot.generation)
+
+        # generation counters: every commit bumps the generation of all predicates written to
+
+        self.coherence_interval  = coherence_interval
+        self.coherence_per_query = coherence_per_query
+        self.generation          = self._init_generation()
+        self.own_generations     = set()    # generations committed by us, newer than self.generation
+        self.ts_generation       = time.time()
+
+        self.module_names        = {}       # module -> set of predicate names recorded in module_predicates
+        self.stats_memo          = {}       # name -> {arity: stats dict}
+        self.tabled              = None     # set of (name, arity) declared via table/1, loaded on demand
+
+        # local modification counter, see changed_since()
+        self.changes             = 0
+        self.changed             = {}       # name -> changes count of its last invalidation
+        self.changed_all         = 0        # changes count of the last full invalidation
+
+    def _upgrade_schema (self, tables):
+
+        """ bring tables which existed before create_all() (db created by an older version)
+            up to date: add missing columns and indexes, fill in the derived columns """
+
+        insp  = inspect(self.engine)
+        added = {}
+
+        with self.engine.begin() as conn:
+
+            for table in model.Base.metadata.sorted_tables:
+
+                if not table.name in tables:
+                    continue
+
+                columns = set(map(lambda c: c['name'], insp.get_columns(table.name)))
+                for column in table.columns:
+                    if column.name in columns:
+                        continue
+                    logging.info ('upgrading db: adding column %s.%s' % (table.name, column.name))
+                    conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name, column.type.compile(dialect=self.engine.dialect)))
+                    added.setdefault(table.name, set()).add(column.name)
+
+                indexes = set(map(lambda i: i['name'], insp.get_indexes(table.name)))
+                for index in table.indexes:
+                    if not index.name in indexes:
+                        index.create(conn)
+
+            if 'prolog_bin' in added.get('clauses', ()):
+                self._upgrade_clauses(conn)
+
+            # predicate names modules contribute to were not tracked before module_predicates existed
+
+            if 'clauses' in tables and not 'module_predicates' in tables:
+                logging.info ('upgrading db: filling in module_predicates')
+                clauses = model.ORMClause.__table__
+                conn.execute(model.ORMModulePredicate.__table__.insert().from_select(['module', 'name'],
+                             select([clauses.c.module, clauses.c.head]).distinct()))
+
+    def _upgrade_clauses (self, conn):
+
+        """ compute prolog_bin and argN of clauses stored as json only """
+
+        table = model.ORMClause.__table__
+        cols  = ['prolog_bin'] + list(map(lambda i: 'arg%d' % i, range(model.MATERIALIZED_ARGS)))
+        stmt  = table.update().where(table.c.id==bindparam('_id')).values(dict(map(lambda c: (c, bindparam(c)), cols)))
+        cnt   = 0
+
+        while True:
+
+            rows = conn.execute(select([table.c.id, table.c.prolog]).where(table.c.prolog_bin==None)
+                                                                    .order_by(table.c.id).limit(UPGRADE_BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+
+            params = []
+            for id, prolog in rows:
+                row = self._clause_row(None, json_to_prolog(prolog), None)
+                p = dict(map(lambda c: (c, row[c]), cols))
+                p['_id'] = id
+                params.append(p)
+
+            conn.execute(stmt, params)
+            cnt += len(rows)
+
+        logging.info ('upgrading db: %d clauses converted' % cnt)
+
+    @property
+    def dirty(self):
+
+        """ names written to in the current thread's transaction """
+
+        dirty = getattr(self.local, 'dirty', None)
+        if dirty is None:
+            dirty = set()
+            self.local.dirty = dirty
+        return dirty
+
+    @dirty.setter
+    def dirty(self, dirty):
+        self.local.dirty = dirty
+
+    @property
+    def stats_pending(self):
+
+        """ stats computed by the current thread, written to the db on commit """
+
+        pending = getattr(self.local, 'stats_pending', None)
+        if pending is None:
+            pending = {}
+            self.local.stats_pending = pending
+        return pending
+
+    def commit(self):
+        logging.debug("commit.")
+        dirty = self.dirty
+        g = self._bump_generations()
+        self._store_stats(dirty)
+        self.session.commit()
+        if g is not None:
+            self._committed_generation(g)
+        for block in self.gensym_blocks.values():
+            block[2] = False
+
+        # other threads may have cached these while our transaction was open
+        if self.threadsafe:
+            for name in dirty:
+                self.invalidate_cache(name)
+
+    def rollback(self):
+
+        """ discard the current thread's uncommitted changes """
+
+        logging.debug("rollback.")
+        dirty = self.dirty
+        self.session.rollback()
+        self.dirty = set()
+        self.local.stats_pending = {}
+
+        for name in dirty:
+            self.invalidate_cache(name)
+        self.module_names = {}
+        self.tabled       = None
+
+        # numbers of blocks reserved in the transaction are free again
+        blocks = self.gensym_blocks
+        for root in [root for root, block in blocks.items() if block[2]]:
+            del blocks[root]
+
+    def _init_generation (self):
+
+        g = self.session.query(model.ORMGeneration).filter(model.ORMGeneration.name==model.GLOBAL_GENERATION).first()
+        if g:
+            return g.generation
+
+        try:
+            self.session.add(model.ORMGeneration(name=model.GLOBAL_GENERATION, generation=0))
+            self.session.commit()
+        except IntegrityError:
+            # created by another process in the meantime
+            self.session.rollback()
+
+        return 0
+
+    def _bump_generations (self):
+
+        """ returns the generation our commit will be visible as (None if nothing was modified) """
+
+        if not self.dirty:
+            return None
+
+        # incrementing the global counter locks its row until commit, so
+        # generations become visible to other processes in increasing order
+
+        self.session.query(model.ORMGeneration).filter(model.ORMGeneration.name==model.GLOBAL_GENERATION) \
+                                                .update({model.ORMGeneration.generation: model.ORMGeneration.generation + 1}, synchronize_session=False)
+        g = self.session.query(model.ORMGeneration.generation).filter(model.ORMGeneration.name==model.GLOBAL_GENERATION).scalar()
+
+        names = sorted(self.dirty)
+        for i in range(0, len(names), SQL_IN_CHUNK_SIZE):
+
+            chunk = names[i:i+SQL_IN_CHUNK_SIZE]
+
+            existing = set(map(lambda r: r[0], self.session.query(model.ORMGeneration.name).filter(model.ORMGeneration.name.in_(chunk))))
+            if existing:
+                self.session.query(model.ORMGeneration).filter(model.ORMGeneration.name.in_(list(existing))) \
+                                                        .update({model.ORMGeneration.generation: g}, synchronize_session=False)
+
+            rows = list(map(lambda name: {'name': name, 'generation': g}, filter(lambda name: not name in existing, chunk)))
+            if rows:
+                self.session.execute(model.ORMGeneration.__table__.insert(), rows)
+
+            self.session.query(model.ORMPredicateStats).filter(model.ORMPredicateStats.name.in_(chunk)).delete(synchronize_session=False)
+
+        self.dirty = set()
+
+        return g
+
+    def _committed_generation (self, g):
+
+        """ our own commits are not modifications by other processes: unless other processes
+            committed in between, we are up to date with g. Otherwise check_generations()
+            still has to look at the generations in between, skipping ours. """
+
+        if g == self.generation + 1:
+            self.generation = g
+        elif g > self.generation:
+            self.own_generations.add(g)
+
+    def check_generations (self):
+
+        """ drop cache entries of predicates modified by other processes since the last check,
+            returns the number of modified predicates seen """
+
+        self.ts_generation = time.time()
+
+        cnt = 0
+        for name, generation in self.session.query(model.ORMGeneration.name, model.ORMGeneration.generation) \
+                                            .filter(model.ORMGeneration.generation > self.generation):
+            if generation > self.generation:
+                self.generation = generation
+            if name == model.GLOBAL_GENERATION or generation in self.own_generations:
+                continue
+            self._shadow(name)
+            self.invalidate_cache(name)
+            cnt += 1
+
+        self.own_generations = set(filter(lambda g: g > self.generation, self.own_generations))
+
+        if cnt:
+            self.tabled = None
+
+        return cnt
+
+    def start_query (self):
+
+        """ called by PrologRuntime at the start of each search """
+
+        if self.coherence_per_query:
+            self.check_generations()
+
+    def close (self, do_commit=True):
+        if do_commit:
+            self.commit()
+        self.session.close()
+        if self.threadsafe:
+            self.session.remove()
+        if self.snapshot:
+            self.snapshot.close()
+            self.snapshot = None
+
+    def export_snapshot (self, path, modules=None):
+
+        """ write predicates of modules (default: all) to a read-only snapshot file which
+            can be opened via LogicDB(..., snapshot=path) """
+
+        self.session.flush()
+        return export_snapshot(self.session, path, modules)
+
+    def _shadow_newer (self, generation):
+
+        """ shadow snapshot names modified in the db after generation """
+
+        for name, in self.session.query(model.ORMGeneration.name).filter(model.ORMGeneration.generation > generation):
+            if name != model.GLOBAL_GENERATION:
+                self._shadow(name)
+
+    def _shadow (self, name):
+        if self.snapshot and name in self.snapshot:
+            self.shadowed.add(name)
+
+    def _modified (self, name):
+        self.dirty.add(name)
+        self._shadow(name)
+        self.invalidate_cache(name)
+
+    def _get_heads (self, module=None):
+        query = self.session.query(model.ORMClause.head).distinct()
+        if module is not None:
+            query = query.filter(model.ORMClause.module==module)
+        return list(map(lambda r: r[0], query))
+
+    def _get_module_names (self, module):
+
+        names = self.module_names.get(module)
+        if names is None:
+            names = set(map(lambda r: r[0], self.session.query(model.ORMModulePredicate.name).filter(model.ORMModulePredicate.module==module)))
+            self.module_names[module] = names
+
+        return names
+
+    def _track_module_names (self, module, names):
+
+        known = self._get_module_names(module)
+
+        for name in names:
+            if name in known:
+                continue
+            self.session.add(model.ORMModulePredicate(module=module, name=name))
+            known.add(name)
+
+    def clear_module(self, module, commit=True):
+
+        """ remove all clauses and docs of module, only cache entries of predicates
+            the module contributed to are evicted. Returns the number of evicted entries. """
+
+        logging.info("Clearing %s ..." % module)
+
+        # re-read names from the db, other processes may have added to this module
+        self.module_names.pop(module, None)
+        names = self._get_module_names(module)
+
+        self.dirty.update(names)
+        self.session.query(model.ORMClause).filter(model.ORMClause.module==module).delete()
+        self.session.query(model.ORMPredicateDoc).filter(model.ORMPredicateDoc.module==module).delete()
+        self.session.query(model.ORMModulePredicate).filter(model.ORMModulePredicate.module==module).delete()
+        self.session.query(model.ORMSourceFile).filter(model.ORMSourceFile.module==module).delete()
+        self.session.query(model.ORMTabledPredicate).filter(model.ORMTabledPredicate.module==module).delete()
+        self.module_names[module] = set()
+        self.tabled = None
+
+        if self.snapshot:
+            self.shadowed.update(self.snapshot.get_names(module))
+
+        if commit:
+            self.commit()
+
+        evicted = 0
+        with self.fill_lock:
+            for name in names:
+                evicted += self._evict(name)
+
+        logging.info("Clearing %s ... done, %d cache entries evicted." % (module, evicted))
+
+        return evicted
+
+    def clear_all_modules(self, commit=True):
+
+        logging.info("Clearing all modules ...")
+        self.dirty.update(self._get_heads())
+        self.session.query(model.ORMClause).delete()
+        self.session.query(model.ORMPredicateDoc).delete()
+        self.session.query(model.ORMModulePredicate).delete()
+        self.session.query(model.ORMSourceFile).delete()
+        self.session.query(model.ORMTabledPredicate).delete()
+        self.module_names = {}
+        self.tabled = None
+
+        if self.snapshot:
+            self.shadowed.update(self.snapshot.get_names())
+        
+        if commit:
+            self.commit()
+
+        with self.fill_lock:
+            evicted = self.cache.clear()
+            self._changed_all()
+
+        logging.info("Clearing all modules ... done, %d cache entries evicted." % evicted)
+
+        return evicted
+
+    def clear_file(self, module, fn, commit=True):
+
+        """ remove the clauses and docs module got from source file fn, returns the number of evicted cache entries """
+
+        names = set(map(lambda r: r[0], self.session.query(model.ORMClause.head).distinct()
+                                                   .filter(model.ORMClause.module==module)
+                                                   .filter(model.ORMClause.fn==fn)))
+
+        self.session.query(model.ORMClause).filter(model.ORMClause.module==module).filter(model.ORMClause.fn==fn).delete()
+        self.session.query(model.ORMPredicateDoc).filter(model.ORMPredicateDoc.module==module).filter(model.ORMPredicateDoc.fn==fn).delete()
+        self.session.query(model.ORMTabledPredicate).filter(model.ORMTabledPredicate.module==module) \
+                                                    .filter(model.ORMTabledPredicate.fn==fn).delete()
+        self.tabled = None
+
+        self.dirty.update(names)
+        for name in names:
+            self._shadow(name)
+
+        if commit:
+            self.commit()
+
+        evicted = 0
+        with self.fill_lock:
+            for name in names:
+                evicted += self._evict(name)
+
+        logging.info("Clearing %s from %s ... done, %d cache entries evicted." % (fn, module, evicted))
+
+        return evicted
+
+    def _get_source_row (self, module, fn):
+        return self.session.query(model.ORMSourceFile).filter(model.ORMSourceFile.module==module).filter(model.ORMSourceFile.fn==fn).first()
+
+    def get_source_file(self, module, fn):
+
+        """ (hash, compiler_version, deps) recorded for the last compilation of fn into module,
+            None if unknown. deps: dict name -> hash of the predicates the compilation inlined """
+
+        ormsf = self._get_source_row(module, fn)
+        if not ormsf or ormsf.hash is None:
+            return None
+        return ormsf.hash, ormsf.compiler_version, json.loads(ormsf.deps) if ormsf.deps else {}
+
+    def set_source_file(self, module, fn, hash, compiler_version, deps=None):
+
+        ormsf = self._get_source_row(module, fn)
+        if not ormsf:
+            ormsf = model.ORMSourceFile(module=module, fn=fn)
+            self.session.add(ormsf)
+
+        ormsf.hash             = hash
+        ormsf.compiler_version = compiler_version
+        ormsf.deps             = json.dumps(deps) if deps else None
+
+    def get_source_pos(self, module, fn):
+
+        """ position (see store()) of the clauses of source file fn in module: assigned at its first
+            compilation, so recompiling a file keeps the order of clauses across files """
+
+        ormsf = self._get_source_row(module, fn)
+        if ormsf and ormsf.pos is not None:
+            return ormsf.pos
+
+        self.session.flush()
+        pos = (self.session.query(func.max(model.ORMClause.id)).scalar() or 0) << model.POS_SHIFT
+
+        if not ormsf:
+            ormsf = model.ORMSourceFile(module=module, fn=fn)
+            self.session.add(ormsf)
+        ormsf.pos = pos
+
+        return pos
+
+    def _clause_row (self, module, clause, fn, pos=None):
+
+        args = clause.head.args
+
+        return {'module'     : module,
+                'arity'      : len(args),
+                'head'       : clause.head.name,
+                'prolog'     : prolog_to_json(clause),
+                'prolog_bin' : prolog_to_bin(clause),
+                'arg0'       : _arg_functor(args[0]) if len(args)>0 else None,
+                'arg1'       : _arg_functor(args[1]) if len(args)>1 else None,
+                'arg2'       : _arg_functor(args[2]) if len(args)>2 else None,
+                'fn'         : fn,
+                'pos'        : pos}
+
+    def store (self, module, clause, fn=None, pos=None):
+
+        """ fn: source file the clause was compiled from, see clear_file()
+            pos: position of the clause in source order (see get_source_pos), lookups return
+                 clauses ordered by it. Default: after all clauses stored so far. """
+
+        ormc = model.ORMClause(**self._clause_row(module, clause, fn, pos))
+
+        # print text_type(clause)
+
+        self.session.add(ormc)
+        self._track_module_names(module, [clause.head.name])
+        self._modified(clause.head.name)
+
+    def store_many (self, module, clauses, batch_size=STORE_BATCH_SIZE, fn=None, pos=None):
+
+        """ bulk insert clauses using executemany(), batch_size rows at a time.
+            Cache entries are invalidated once per batch. Returns the number of clauses stored.
+            fn, pos: see store(), pos is the position of the first clause, the others follow it """
+
+        ts_start = time.time()
+
+        # pending ORM objects go first so clause ids stay in source order
+        self.session.flush()
+
+        table = model.ORMClause.__table__
+        cnt   = 0
+        rows  = []
+        names = set()
+
+        for clause in clauses:
+
+            rows.append(self._clause_row(module, clause, fn, pos + cnt + len(rows) if pos is not None else None))
+            names.add(clause.head.name)
+
+            if len(rows) >= batch_size:
+                self._store_batch(table, module, rows, names)
+                cnt  += len(rows)
+                rows  = []
+                names = set()
+
+        if rows:
+            self._store_batch(table, module, rows, names)
+            cnt += len(rows)
+
+        ts_delay = time.time() - ts_start
+        logging.info (u'store_many: %d clauses stored in %fs (%d rows/s)' % (cnt, ts_delay, cnt / ts_delay if ts_delay > 0 else cnt))
+
+        return cnt
+
+    def _store_batch (self, table, module, rows, names):
+
+        self.session.execute(table.insert(), rows)
+        self._track_module_names(module, names)
+        for name in names:
+            self._modified(name)
+      
+    def _evict (self, name):
+
+        """ drop cached clauses and stats of name, caller holds fill_lock """
+
+        self.stats_memo.pop(name, None)
+        self.changes += 1
+        self.changed[name] = self.changes
+        return self.cache.invalidate(name)
+
+    def _changed_all (self):
+
+        """ everything may have changed, caller holds fill_lock """
+
+        self.stats_memo  = {}
+        self.changes    += 1
+        self.changed     = {}
+        self.changed_all = self.changes
+
+    def invalidate_cache(self, name=None):
+        with self.fill_lock:
+            if name:
+                self._evict(name)
+            else:
+                self.cache.clear()
+                self._changed_all()
+
+    def changed_since (self, names, changes):
+
+        """ True if any of the predicates names may have been modified since
+            the changes counter was at changes """
+
+        if self.changed_all > changes:
+            return True
+        for name in names:
+            if self.changed.get(name, 0) > changes:
+                return True
+        return False
+
+    def set_tabled (self, module, name, arity, fn=None):
+        self.session.merge(model.ORMTabledPredicate(module=module, name=name, arity=arity, fn=fn))
+        self.tabled = None
+
+    def is_tabled (self, name, arity):
+
+        """ True if name/arity has been declared via table/1 """
+
+        tabled = self.tabled
+        if tabled is None:
+            tabled = set(self.session.query(model.ORMTabledPredicate.name, model.ORMTabledPredicate.arity))
+            self.tabled = tabled
+        return (name, arity) in tabled
+
+    def get_cache_stats(self):
+        return self.cache.get_stats()
+
+    def stats (self, name, arity):
+
+        """ statistics of predicate name/arity: dict of clauses (count), facts, rules,
+            fact_ratio and distinct (number of distinct non-variable values per argument position).
+
+            Stats are kept in the predicate_stats table, writing to a predicate drops its row
+            on commit, it is recomputed on the next call. Recomputed stats are written to the
+            table by the next commit(), stats() itself does not write to the db. """
+
+        if self._coherence_due(time.time()):
+            self.check_generations()
+
+        res = self.stats_memo.get(name, {}).get(arity)
+        if res is not None:
+            return res
+
+        # names written to in the current transaction: the row is outdated and dropped on commit anyway
+
+        dirty = name in self.dirty
+
+        orms = None
+        if not dirty:
+            orms = self.session.query(model.ORMPredicateStats).filter(model.ORMPredicateStats.name==name) \
+                                                              .filter(model.ORMPredicateStats.arity==arity).first()
+        if orms:
+            res = _predicate_stats(orms.clauses, orms.facts, json.loads(orms.distinct))
+
+        else:
+
+            res = compute_stats(arity, self._stats_clauses(name, arity))
+
+            if not dirty:
+                self.stats_pending[(name, arity)] = res
+
+        with self.fill_lock:
+            self.stats_memo.setdefault(name, {})[arity] = res
+
+        return res
+
+    def _store_stats (self, dirty):
+
+        """ write stats computed since the last commit, except for names written to in the meantime """
+
+        for (name, arity), res in sorted(self.stats_pending.items()):
+            if name in dirty:
+                continue
+            self.session.merge(model.ORMPredicateStats(name=name, arity=arity, clauses=res['clauses'],
+                                                       facts=res['facts'], distinct=json.dumps(res['distinct'])))
+
+        self.local.stats_pending = {}
+
+    def _stats_clauses (self, name, arity):
+
+        # reuse cached clauses if we have them, do not fill the cache otherwise
+
+        ci = self.cache.peek(name)
+        if ci is not None:
+            res = ci.lookup(arity, None)
+            if res is not None:
+                return res
+
+        if self.snapshot and (name in self.snapshot) and not (name in self.shadowed):
+            return self.snapshot.load(name, arity)
+
+        query = self.session.query(model.ORMClause).filter(model.ORMClause.head==name).filter(model.ORMClause.arity==arity)
+        return map(_clause_from_orm, query.yield_per(PRELOAD_BATCH_SIZE))
+
+    def reset_cache_stats(self):
+        self.cache.reset_stats()
+
+    def store_doc (self, module, name, doc, fn=None):
+
+        ormd = model.ORMPredicateDoc(module = module,
+                                     name   = name,
+                                     doc    = doc,
+                                     fn     = fn)
+        # merge: recompiling a changed source file re-stores its docs
+        self.session.merge(ormd)
+
+    def _pattern_filter (self, p):
+
+        """ sql condition selecting candidate rows for retract pattern p (see _match_p) """
+
+        conds = [model.ORMClause.arity==len(p.args)]
+
+        for i, a in enumerate(p.args[:model.MATERIALIZED_ARGS]):
+
+            if isinstance(a, Variable):
+                continue
+
+            col = getattr(model.ORMClause, 'arg%d' % i)
+
+            # clause args which are variables always match, literals are NULL as well
+            if isinstance(a, Predicate):
+                conds.append(or_(col==_arg_functor(a), col==None))
+            else:
+                conds.append(col==None)
+
+        return and_(*conds)
+
+    def retract_clauses (self, name, patterns):
+
+        """ remove stored clauses of predicate name whose head matches any of patterns,
+            returns the number of clauses removed """
+
+        if not patterns:
+            return 0
+
+        # only candidate rows are fetched and decoded, using the arity and argN columns.
+        # each pattern filter binds up to 1 + MATERIALIZED_ARGS parameters
+
+        chunk_size = SQL_IN_CHUNK_SIZE // (1 + model.MATERIALIZED_ARGS)
+
+        to_delete = []
+        seen      = set()
+
+        for i in range(0, len(patterns), chunk_size):
+
+            chunk = patterns[i:i+chunk_size]
+
+            query = self.session.query(model.ORMClause.id, model.ORMClause.prolog, model.ORMClause.prolog_bin) \
+                                .filter(model.ORMClause.head==name) \
+                                .filter(or_(*list(map(self._pattern_filter, chunk))))
+
+            for row in query:
+                if row.id in seen:
+                    continue
+                clause = _clause_from_orm(row)
+                for p in chunk:
+                    if _match_p(clause.head, p):
+                        to_delete.append(row.id)
+                        seen.add(row.id)
+                        break
+
+        for i in range(0, len(to_delete), SQL_IN_CHUNK_SIZE):
+            chunk = to_delete[i:i+SQL_IN_CHUNK_SIZE]
+            self.session.query(model.ORMClause).filter(model.ORMClause.id.in_(chunk)).delete(synchronize_session=False)
+
+        if to_delete:
+            self._modified(name)
+
+        return len(to_delete)
+
+    def _gensym_in_session (self):
+
+        """ True if gensym blocks have to be reserved in the session's transaction: on sqlite
+            a separate connection would either be the in-memory database's only connection
+            (committing the session's pending writes) or wait for the write lock held by
+            the session """
+
+        if self.engine.dialect.name != 'sqlite':
+            return False
+        if self.engine.url.database in (None, '', ':memory:'):
+            return True
+        return self.session.connection().info.get('written', False)
+
+    def _update_gensym_num (self, conn, root, n):
+
+        table = model.ORMGensymNum.__table__
+
+        res = conn.execute(table.update().where(table.c.root==root)
+                                         .values(current_num=table.c.current_num + n))
+        if res.rowcount == 0:
+            conn.execute(table.insert().values(root=root, current_num=n))
+
+        hi = conn.execute(select([table.c.current_num]).where(table.c.root==root)).scalar()
+
+        return hi - n + 1, hi
+
+    def _reserve_gensym_block (self, root, n):
+
+        """ reserve the next n numbers for root in a short transaction of its own, committed
+            before the numbers are used. Where that is not possible (see _gensym_in_session)
+            the reservation is part of the session's transaction and rollback() gives the
+            numbers back.
+            Returns [first, last, reserved in session] """
+
+        if self._gensym_in_session():
+            # the session holds the database write lock already, nobody can race us
+            return list(self._update_gensym_num(self.session, root, n)) + [True]
+
+        while True:
+            try:
+                with self.engine.begin() as conn:
+                    return list(self._update_gensym_num(conn, root, n)) + [False]
+            except IntegrityError:
+                # another process inserted the same root concurrently, retry the update
+                continue
+
+    @property
+    def gensym_blocks(self):
 
-from copy           import deepcopy, copy
-from sqlalchemy     import create_engine
-from sqlalchemy.orm import sessionmaker
-from six            import python_2_unicode_compatible, text_type
-from zamiaprolog    import model
+        """ the current thread's blocks: root -> [next num, last num, reserved in session] """
 
-from zamiaprolog.logic import *
-from nltools.misc      import limit_str
+        blocks = getattr(self.local, 'gensym_blocks', None)
+        if blocks is None:
+            blocks = {}
+            self.local.gensym_blocks = blocks
+        return blocks
 
-class LogicDB(object):
+    def gensym (self, root):
 
-    def __init__(self, db_url, echo=False):
+        """ hi/lo allocation: numbers are handed out from blocks of gensym_block_size
+            reserved in the db, unique across processes (but not gap-free). Blocks
+            are per thread so a rollback never takes back numbers another thread
+            has handed out already. """
 
-        self.engine  = create_engine(db_url, echo=echo)
-        self.Session = sessionmaker(bind=self.engine)
-        self.session = self.Session()
-        model.Base.metadata.create_all(self.engine)
-        self.cache = {}
+        block = self.gensym_blocks.get(root)
+        if block is None or block[0] > block[1]:
+            block = self._reserve_gensym_block(root, self.gensym_block_size)
+            self.gensym_blocks[root] = block
 
-    def commit(self):
-        logging.debug("commit.")
-        self.session.commit()
+        num = block[0]
+        block[0] += 1
+        return root + str(num)
 
-    def close (self, do_commit=True):
-        if do_commit:
-            self.commit()
-        self.session.close()
+    def _load (self, ci, arity, sf):
 
-    def clear_module(self, module, commit=True):
+        """ fetch clauses for a lookup that ci cannot answer yet. arity and the static filter
+            on materialized argument columns are applied in sql - until PARTIAL_LOAD_LIMIT
+            different filters have been seen, then the whole name/arity is loaded.
+            Modifies ci, which must not be in the cache. """
 
-        logging.info("Clearing %s ..." % module)
-        self.session.query(model.ORMClause).filter(model.ORMClause.module==module).delete()
-        self.session.query(model.ORMPredicateDoc).filter(model.ORMPredicateDoc.module==module).delete()
-        logging.info("Clearing %s ... done." % module)
+        if self.snapshot and (ci.name in self.snapshot) and not (ci.name in self.shadowed):
 
-        if commit:
-            self.commit()
-        self.invalidate_cache()
+            if arity<0:
+                ci.set_clauses(self.snapshot.load(ci.name))
+                return ci.clauses
 
-    def clear_all_modules(self, commit=True):
+            ai = ci.set_arity(arity, self.snapshot.load(ci.name, arity))
+            return ai.lookup(sf)
 
-        logging.info("Clearing all modules ...")
-        self.session.query(model.ORMClause).delete()
-        self.session.query(model.ORMPredicateDoc).delete()
-        logging.info("Clearing all modules ... done.")
-        
-        if commit:
-            self.commit()
-        self.invalidate_cache()
+        query = self.session.query(model.ORMClause).filter(model.ORMClause.head==ci.name)
 
-    def store (self, module, clause):
+        if arity<0:
+            ci.set_clauses(map(_clause_from_orm, query.order_by(model.clause_order, model.ORMClause.id)))
+            return ci.clauses
 
-        ormc = model.ORMClause(module    = module,
-                               arity     = len(clause.head.args), 
-                               head      = clause.head.name, 
-                               prolog    = prolog_to_json(clause))
+        query = query.filter(model.ORMClause.arity==arity)
 
-        # print text_type(clause)
+        positions = []
+        if sf and ci.get_partial_loads(arity) < PARTIAL_LOAD_LIMIT:
+            positions = list(filter(lambda i: i < model.MATERIALIZED_ARGS, sorted(sf)))
 
-        self.session.add(ormc)
-        self.invalidate_cache(clause.head.name)
-      
-    def invalidate_cache(self, name=None):
-        if name and name in self.cache:
-            del self.cache[name]
-        else:
-            self.cache = {}
+        if not positions:
+            ai = ci.set_arity(arity, map(_clause_from_orm, query.order_by(model.clause_order, model.ORMClause.id)))
+            return ai.lookup(sf)
 
-    def store_doc (self, module, name, doc):
+        for i in positions:
+            col = getattr(model.ORMClause, 'arg%d' % i)
+            query = query.filter(or_(col==sf[i], col==None))
 
-        ormd = model.ORMPredicateDoc(module = module,
-                                     name   = name,
-                                     doc    = doc)
-        self.session.add(ormd)
+        # argN only narrows things down (compound functors, args beyond MATERIALIZED_ARGS)
+
+        clauses = map(_clause_from_orm, query.order_by(model.clause_order, model.ORMClause.id))
+        return ci.set_partial(arity, sf, filter(lambda c: _sf_matches(c, sf), clauses))
+
+    def _coherence_due (self, ts):
+        return (self.coherence_interval is not None) and (ts - self.ts_generation >= self.coherence_interval)
+
+    def lookup_async (self, name, arity, overlay=None, sf=None, executor=None):
+
+        """ asyncio variant of lookup(): returns a future resolving to the clauses. Lookups the
+            clause cache can answer complete immediately, anything involving db i/o runs in
+            executor (default: self.executor). Without threadsafe=True the session must not
+            be used from executor threads, such lookups are done synchronously whatever the
+            executor. """
+
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+
+        if executor is None:
+            executor = self.executor
+
+        sync = not self.threadsafe
+
+        if not sync and not self._coherence_due(time.time()):
+            ci = self.cache.peek(name)
+            sync = ci is not None and ci.lookup(arity, sf) is not None
+
+        if sync:
+            future = loop.create_future()
+            future.set_result(self.lookup(name, arity, overlay=overlay, sf=sf))
+            return future
+
+        return loop.run_in_executor(executor, functools.partial(self._executor_lookup, name, arity, overlay, sf))
+
+    def _executor_lookup (self, name, arity, overlay, sf):
+
+        """ lookup() on an executor thread. Executor threads outlive the lookup, so their scoped
+            session is removed again - it would keep its connection checked out (idle in
+            transaction) and sqlite connections cannot be closed from other threads later. """
+
+        try:
+            return self.lookup(name, arity, overlay=overlay, sf=sf)
+        finally:
+            if self.threadsafe:
+                self.session.remove()
+
+    def preload (self, modules=None, predicates=None):
+
+        """ fill the clause cache for all predicates defined in modules and/or named in
+            predicates (default: everything) using a single ordered query.
+            Returns the number of clauses loaded. """
+
+        ts_start = time.time()
+
+        query = self.session.query(model.ORMClause)
+
+        # a predicate can have clauses in several modules, always load all of them
+        if modules is not None:
+            heads = self.session.query(model.ORMClause.head).filter(model.ORMClause.module.in_(list(modules))).distinct()
+            query = query.filter(model.ORMClause.head.in_(heads.subquery()))
+        if predicates is not None:
+            query = query.filter(model.ORMClause.head.in_(list(predicates)))
+
+        query = query.order_by(model.ORMClause.head, model.clause_order, model.ORMClause.id)
+
+        cnt     = 0
+        npreds  = 0
+        name    = None
+        group   = []
+
+        def fill(name, rows):
+            # predicates served by the snapshot are decoded lazily from the mmap
+            if self.snapshot and (name in self.snapshot) and not (name in self.shadowed):
+                return 0
+            ci = ClauseIndex(name)
+            ci.set_clauses(map(_clause_from_orm, rows))
+            nclauses, nbytes = ci.get_size()
+            with self.fill_lock:
+                self.cache.put(name, ci, nclauses, nbytes)
+            return 1
+
+        for ormc in query.yield_per(PRELOAD_BATCH_SIZE):
+
+            if ormc.head != name:
+                if group:
+                    npreds += fill(name, group)
+                name  = ormc.head
+                group = []
+
+            group.append(ormc)
+            cnt += 1
+
+            if cnt % PRELOAD_BATCH_SIZE == 0:
+                logging.info ('preload: %d clauses, %d predicates loaded so far ...' % (cnt, npreds))
+
+        if group:
+            npreds += fill(name, group)
+
+        logging.info ('preload: %d clauses, %d predicates loaded in %fs.' % (cnt, npreds, time.time() - ts_start))
+
+        return cnt
+
+    def _acquire_name_lock (self, name):
+
+        with self.fill_lock:
+            nl = self.name_locks.get(name)
+            if nl is None:
+                nl = [threading.Lock(), 0]
+                self.name_locks[name] = nl
+            nl[1] += 1
+
+        nl[0].acquire()
+
+    def _release_name_lock (self, name):
+
+        with self.fill_lock:
+            nl = self.name_locks[name]
+            nl[0].release()
+            nl[1] -= 1
+            if not nl[1]:
+                del self.name_locks[name]
+
+    def _fill (self, name, arity, sf):
+
+        """ answer a lookup the cache could not answer. Loads of the same name are serialized,
+            fill_lock is only held to access the cache, not during db round trips. """
+
+        self._acquire_name_lock(name)
+        try:
+
+            # another thread may have filled it in the meantime
+
+            with self.fill_lock:
+                changes = self.changes
+                ci = self.cache.peek(name)
+
+            res = ci.lookup(arity, sf) if ci is not None else None
+            if res is None:
+
+                # readers do not lock: the cached index is never modified, we load into
+                # a copy and replace it
+
+                ci  = ci.copy() if ci is not None else ClauseIndex(name)
+                res = self._load(ci, arity, sf)
+                nclauses, nbytes = ci.get_size()
+
+                # do not cache what might have been read before an invalidation
+                with self.fill_lock:
+                    if not self.changed_since([name], changes):
+                        self.cache.put(name, ci, nclauses, nbytes)
+
+            return res
+
+        finally:
+            self._release_name_lock(name)
 
     # use arity=-1 to disable filtering
+    # returns a read-only sequence of clauses (tuple or ClauseView)
     def lookup (self, name, arity, overlay=None, sf=None):
 
         ts_start = time.time()
 
+        if self._coherence_due(ts_start):
+            self.check_generations()
+
         # if name == 'lang':
         #     import pdb; pdb.set_trace()
 
         # DB caching
 
-        if name in self.cache:
-            res = copy(self.cache[name])
+        ci = self.cache.peek(name)
 
+        # indexed lookup, result is a shared tuple - the overlay
+        # wraps it in a ClauseView instead of modifying it. Partially
+        # loaded indices may not be able to answer, that is a miss.
+
+        res = ci.lookup(arity, sf) if ci is not None else None
+        if res is None:
+            self.cache.miss()
+            res = self._fill(name, arity, sf)
         else:
-            res = []
+            self.cache.hit(name)
 
-            for ormc in self.session.query(model.ORMClause).filter(model.ORMClause.head==name).order_by(model.ORMClause.id).all():
+        if overlay:
+            res = overlay.do_filter(name, res, arity, sf)
 
-                res.append (json_to_prolog(ormc.prolog))
+        ts_delay = time.time() - ts_start
+        # logging.debug (u'db lookup for %s/%d took %fs' % (name, arity, ts_delay))
 
-            self.cache[name] = copy(res)
-       
-        if overlay:
-            res = overlay.do_filter(name, res)
+        return res
 
-        if arity<0:
-            return res
+class ClauseView(object):
 
-        res2 = []
-        for clause in res:
-    
-            if len(clause.head.args) != arity:
-                continue
+    """ read-only, lazily evaluated sequence of db clauses with overlay changes applied:
+        base clauses not matched by the retract index (if any), followed by extra clauses.
+        Iteration (forward and reversed) does not copy the base clauses unless they have
+        to be filtered, which happens once. len() and indexing materialize the view once. """
 
-            match = True
-            if sf:
-                for i in sf:
-                    ca = sf[i]
-                    a  = clause.head.args[i]
-                    
-                    if not isinstance(a, Predicate):
-                        continue
-                    if (a.name != ca) or (len(a.args) !=0):
-                        # logging.info('no match: %s vs %s %s' % (repr(ca), repr(a), text_type(clause)))
-                        match=False
-                        break
-            if not match:
-                continue
-            res2.append(clause)
+    __slots__ = ('base', 'retracted', 'extra', 'items')
 
-        ts_delay = time.time() - ts_start
-        # logging.debug (u'db lookup for %s/%d took %fs' % (name, arity, ts_delay))
+    def __init__(self, base, retracted, extra):
+        self.base      = base
+        self.retracted = retracted
+        self.extra     = extra
+        self.items     = None
+
+    def _base (self):
+
+        if self.retracted is not None:
+            retracted      = self.retracted
+            self.base      = tuple(filter(lambda clause: not retracted.matches(clause.head), self.base))
+            self.retracted = None
+
+        return self.base
+
+    def __iter__ (self):
+        if self.items is not None:
+            return iter(self.items)
+        return itertools.chain(self._base(), self.extra)
+
+    def __reversed__ (self):
+        if self.items is not None:
+            return reversed(self.items)
+        return itertools.chain(reversed(self.extra), reversed(self._base()))
+
+    def _materialize (self):
+        if self.items is None:
+            self.items = tuple(itertools.chain(self._base(), self.extra))
+        return self.items
+
+    def __len__ (self):
+        return len(self._materialize())
+
+    def __getitem__ (self, i):
+        return self._materialize()[i]
+
+    def __bool__ (self):
+        if self.items is not None:
+            return len(self.items) > 0
+        for c in self:
+            return True
+        return False
+
+    __nonzero__ = __bool__
+
+# retract index keys for the first argument
+
+_RKEY_NOARGS   = 0
+_RKEY_LITERAL  = 1
+
+def _first_arg_key (p):
+
+    """ None for variables (matches anything), (name, nargs) for predicates """
+
+    if len(p.args) == 0:
+        return _RKEY_NOARGS
+
+    a = p.args[0]
+
+    if isinstance(a, Variable):
+        return None
+    if isinstance(a, Literal):
+        return _RKEY_LITERAL
+
+    return (a.name, len(a.args))
+
+class RetractIndex(object):
+
+    """ retract patterns of one predicate name indexed by arity and first argument """
+
+    def __init__(self, patterns):
+
+        self.arities = {}   # arity -> (wildcards, key -> patterns)
+
+        for p in patterns:
+
+            wildcards, buckets = self.arities.setdefault(len(p.args), ([], {}))
+
+            k = _first_arg_key(p)
+            if k is None:
+                wildcards.append(p)
+            else:
+                buckets.setdefault(k, []).append(p)
+
+    def matches (self, head):
+
+        """ True if head is matched by any of the patterns """
+
+        entry = self.arities.get(len(head.args))
+        if entry is None:
+            return False
+
+        wildcards, buckets = entry
+
+        for p in wildcards:
+            if _match_p(head, p):
+                return True
 
-        return res2
+        k = _first_arg_key(head)
+
+        if k is None:
+            for l in buckets.values():
+                for p in l:
+                    if _match_p(head, p):
+                        return True
+            return False
+
+        for p in buckets.get(k, ()):
+            if _match_p(head, p):
+                return True
+
+        return False
+
+def _match_p (p1, p2):
+
+    """ extremely simplified variant of full-blown unification - just enough to get basic retract/1 working """
+
+    if isinstance (p1, Variable):
+        return True
+
+    if isinstance (p2, Variable):
+        return True
+
+    elif isinstance (p1, Literal):
+        return p1 == p2
+
+    elif p1.name != p2.name:
+        return False
+
+    elif len(p1.args) != len(p2.args): 
+        return False
+
+    else:
+        for i in range(len(p1.args)):
+            if not _match_p(p1.args[i], p2.args[i]):
+                return False
+
+    return True
+
+_overlay_versions = itertools.count(1)
 
 @python_2_unicode_compatible
 class LogicDBOverlay(object):
 
+    """ asserted and retracted clauses not (yet) applied to the db.
+
+        d_assertz and d_retracted are persistent maps of predicate name -> cons list,
+        so clone() is O(1) and assertz/retract share structure with the overlay they
+        were derived from - which is never modified by them.
+
+        version identifies the overlay's contents, clones share it along with the
+        memoized do_filter results, asserted/retracted tuples and retract indexes. """
+
     def __init__(self):
 
-        self.d_assertz   = {}
-        self.d_retracted = {}
+        self.d_assertz   = EMPTY_MAP
+        self.d_retracted = EMPTY_MAP
+        self._new_version()
 
-    def clone(self):
-        clone = LogicDBOverlay()
+    def _new_version(self):
+        self.version = next(_overlay_versions)
+        self.views     = {}    # (name, arity, sf items) -> (db lookup result, ClauseView)
+        self.rindex    = {}    # name -> RetractIndex
+        self.asserted  = {}    # name -> tuple of asserted clauses
+        self.retracted = {}    # name -> tuple of retracted patterns
 
-        for name in self.d_retracted:
-            for c in self.d_retracted[name]:
-                clone.retract(c)
+    def clone(self):
+        clone = LogicDBOverlay.__new__(LogicDBOverlay)
 
-        for name in self.d_assertz:
-            for c in self.d_assertz[name]:
-                clone.assertz(c)
+        clone.d_assertz   = self.d_assertz
+        clone.d_retracted = self.d_retracted
+        clone.version     = self.version
+        clone.views       = self.views
+        clone.rindex      = self.rindex
+        clone.asserted    = self.asserted
+        clone.retracted   = self.retracted
 
         return clone
 
@@ -181,84 +1690,86 @@ class LogicDBOverlay(object):
 
         name = clause.head.name
 
-        if name in self.d_assertz:
-            self.d_assertz[name].append(clause)
-        else:
-            self.d_assertz[name] = [clause]
+        self.d_assertz = self.d_assertz.set(name, (clause, self.d_assertz.get(name)))
+        self._new_version()
 
     def _match_p (self, p1, p2):
+        return _match_p(p1, p2)
 
-        """ extremely simplified variant of full-blown unification - just enough to get basic retract/1 working """
+    def get_asserted (self, name):
+        res = self.asserted.get(name)
+        if res is None:
+            res = cons_to_tuple(self.d_assertz.get(name))
+            self.asserted[name] = res
+        return res
 
-        if isinstance (p1, Variable):
-            return True
+    def get_retracted (self, name):
+        res = self.retracted.get(name)
+        if res is None:
+            res = cons_to_tuple(self.d_retracted.get(name))
+            self.retracted[name] = res
+        return res
 
-        if isinstance (p2, Variable):
-            return True
+    def get_names (self):
 
-        elif isinstance (p1, Literal):
-            return p1 == p2
+        """ names of the predicates this overlay modifies """
 
-        elif p1.name != p2.name:
-            return False
+        return set(self.d_assertz) | set(self.d_retracted)
 
-        elif len(p1.args) != len(p2.args): 
-            return False
+    def retract (self, p):
+        name = p.name
 
-        else:
-            for i in range(len(p1.args)):
-                if not self._match_p(p1.args[i], p2.args[i]):
-                    return False
+        asserted = self.get_asserted(name)
+        if asserted:
+            l = list(filter(lambda c: not self._match_p(p, c.head), asserted))
+            if len(l) < len(asserted):
+                self.d_assertz = self.d_assertz.set(name, cons_from(l))
 
-        return True
+        self.d_retracted = self.d_retracted.set(name, (p, self.d_retracted.get(name)))
+        self._new_version()
 
+    def do_filter (self, name, res, arity=-1, sf=None):
 
-    def retract (self, p):
-        name = p.name
+        """ apply overlay changes to db lookup result res. res is not modified,
+            if the overlay affects name a ClauseView is returned """
 
-        if name in self.d_assertz:
-            l = []
-            for c in self.d_assertz[name]:
-                if not self._match_p(p, c.head):
-                    l.append(c)
-            self.d_assertz[name] = l
+        if not (name in self.d_assertz or name in self.d_retracted):
+            return res
 
-        if name in self.d_retracted:
-            self.d_retracted[name].append(p)
-        else:
-            self.d_retracted[name] = [p]
+        key = (name, arity, tuple(sorted(sf.items())) if sf else None)
 
-    def do_filter (self, name, res):
+        # memoized as long as the db lookup result is the same (i.e. still cached)
+        memo = self.views.get(key)
+        if memo is not None and memo[0] is res:
+            return memo[1]
 
+        retracted = None
         if name in self.d_retracted:
-            res2 = []
-            for clause in res:
-                for p in self.d_retracted[name]:
-                    if not self._match_p(clause.head, p):
-                        res2.append(clause)
-            res = res2
+            retracted = self.rindex.get(name)
+            if retracted is None:
+                retracted = RetractIndex(self.get_retracted(name))
+                self.rindex[name] = retracted
 
-        # append overlay clauses
+        extra = tuple(filter(lambda c: _clause_matches(c, arity, sf), self.get_asserted(name)))
 
-        if name in self.d_assertz:
-            for clause in self.d_assertz[name]:
-                res.append(clause)
+        view = ClauseView(res, retracted, extra)
+        self.views[key] = (res, view)
 
-        return res
+        return view
 
     def log_trace (self, indent):
         for k in sorted(self.d_assertz):
-            for clause in self.d_assertz[k]:
+            for clause in self.get_asserted(k):
                 logging.info(u"%s   [O] %s" % (indent, limit_str(text_type(clause), 100)))
         # FIXME: log retracted clauses?
 
     def __str__ (self):
         res = u'DBOvl('
         for k in sorted(self.d_assertz):
-            for clause in self.d_assertz[k]:
+            for clause in self.get_asserted(k):
                 res += u'+' + limit_str(text_type(clause), 40)
         for k in sorted(self.d_retracted):
-            for p in self.d_retracted[k]:
+            for p in self.get_retracted(k):
                 res += u'-' + limit_str(text_type(p), 40)
 
         res += u')'
@@ -269,40 +1780,261 @@ class LogicDBOverlay(object):
 
     def do_apply(self, module, db, commit=True):
 
-        to_delete = set()
+        """ persist overlay changes in db: retracts first, then one bulk insert of all
+            asserted clauses. Only affected cache entries are evicted. """
 
         for name in self.d_retracted:
-            for ormc in db.session.query(model.ORMClause).filter(model.ORMClause.head==name).all():
-                clause = json_to_prolog(ormc.prolog)
-                for p in self.d_retracted[name]:
-                    if self._match_p(clause.head, p):
-                        to_delete.add(ormc.id)
-
-        if to_delete:
-           db.session.query(model.ORMClause).filter(model.ORMClause.id.in_(list(to_delete))).delete(synchronize_session='fetch')
-           db.invalidate_cache()
+            db.retract_clauses(name, self.get_retracted(name))
 
+        clauses = []
         for name in self.d_assertz:
-            for clause in self.d_assertz[name]:
-                db.store(module, clause)
+            clauses.extend(self.get_asserted(name))
+        if clauses:
+            db.store_many(module, clauses)
 
         if commit:
             db.commit()
 
 
-# class LogicMemDB(object):
-# 
-#     def __init__(self):
-#         self.clauses = {}
-# 
-#     def store (self, clause):
-#         if clause.head.name in self.clauses:
-#             self.clauses[clause.head.name].append (clause)
-#         else:
-#             self.clauses[clause.head.name] = [clause]
-#        
-#     def lookup (self, name):
-#         if name in self.clauses:
-#             return self.clauses[name]
-#         return []
+class LogicMemDB(object):
+
+    """ pure in-memory backend implementing the LogicDB interface, nothing is persisted.
+        Clauses are kept per predicate name in store order, indexes are built on demand
+        and dropped whenever a predicate is modified. """
+
+    def __init__(self):
+
+        self.clauses = {}     # name -> list of (module, clause, fn, pos) ordered by pos
+        self.docs    = {}     # name -> (module, doc, fn)
+        self.gensyms = {}     # root -> current num
+        self.indexes = {}     # name -> ClauseIndex
+        self.sources = {}     # (module, fn) -> (hash, compiler_version, deps)
+        self.spos    = {}     # (module, fn) -> pos, see LogicDB.get_source_pos
+        self.nstored = 0      # number of clauses stored, plays the role of LogicDB's clause ids
+        self.tabled  = {}     # (name, arity) -> list of (module, fn)
+
+        self.changes     = 0
+        self.changed     = {} # name -> changes count of its last modification
+        self.changed_all = 0
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+
+        """ no transactions: changes take effect immediately and cannot be rolled back """
+
+        pass
+
+    def close (self, do_commit=True):
+        pass
+
+    def clear_module(self, module, commit=True):
+
+        logging.info("Clearing %s ..." % module)
+
+        evicted = 0
+
+        for name in list(self.clauses):
+            l = list(filter(lambda mc: mc[0] != module, self.clauses[name]))
+            if len(l) == len(self.clauses[name]):
+                continue
+            if l:
+                self.clauses[name] = l
+            else:
+                del self.clauses[name]
+            if name in self.indexes:
+                evicted += 1
+            self.invalidate_cache(name)
+
+        for name in list(self.docs):
+            if self.docs[name][0] == module:
+                del self.docs[name]
 
+        for key in list(self.sources):
+            if key[0] == module:
+                del self.sources[key]
+        for key in list(self.spos):
+            if key[0] == module:
+                del self.spos[key]
+
+        self._clear_tabled(lambda mf: mf[0] == module)
+
+        logging.info("Clearing %s ... done, %d cache entries evicted." % (module, evicted))
+
+        return evicted
+
+    def clear_file(self, module, fn, commit=True):
+
+        evicted = 0
+
+        for name in list(self.clauses):
+            l = list(filter(lambda mc: mc[0] != module or mc[2] != fn, self.clauses[name]))
+            if len(l) == len(self.clauses[name]):
+                continue
+            if l:
+                self.clauses[name] = l
+            else:
+                del self.clauses[name]
+            if name in self.indexes:
+                evicted += 1
+            self.invalidate_cache(name)
+
+        for name in list(self.docs):
+            if self.docs[name][0] == module and self.docs[name][2] == fn:
+                del self.docs[name]
+
+        self._clear_tabled(lambda mf: mf == (module, fn))
+
+        return evicted
+
+    def get_source_file(self, module, fn):
+        return self.sources.get((module, fn))
+
+    def set_source_file(self, module, fn, hash, compiler_version, deps=None):
+        self.sources[(module, fn)] = (hash, compiler_version, deps or {})
+
+    def get_source_pos(self, module, fn):
+        return self.spos.setdefault((module, fn), self.nstored << model.POS_SHIFT)
+
+    def clear_all_modules(self, commit=True):
+
+        logging.info("Clearing all modules ...")
+        self.clauses = {}
+        self.docs    = {}
+        self.sources = {}
+        self.spos    = {}
+        self.tabled  = {}
+
+        evicted = len(self.indexes)
+        self.invalidate_cache()
+
+        logging.info("Clearing all modules ... done, %d cache entries evicted." % evicted)
+
+        return evicted
+
+    def store (self, module, clause, fn=None, pos=None):
+
+        name = clause.head.name
+
+        self.nstored += 1
+        if pos is None:
+            pos = self.nstored << model.POS_SHIFT
+
+        l = self.clauses.setdefault(name, [])
+        i = len(l)
+        while i > 0 and l[i-1][3] > pos:
+            i -= 1
+        l.insert(i, (module, clause, fn, pos))
+
+        self.invalidate_cache(name)
+
+    def store_many (self, module, clauses, batch_size=STORE_BATCH_SIZE, fn=None, pos=None):
+
+        cnt = 0
+        for clause in clauses:
+            self.store(module, clause, fn, pos + cnt if pos is not None else None)
+            cnt += 1
+
+        return cnt
+
+    def invalidate_cache(self, name=None):
+        self.changes += 1
+        if name:
+            self.indexes.pop(name, None)
+            self.changed[name] = self.changes
+        else:
+            self.indexes     = {}
+            self.changed     = {}
+            self.changed_all = self.changes
+
+    def changed_since (self, names, changes):
+
+        if self.changed_all > changes:
+            return True
+        for name in names:
+            if self.changed.get(name, 0) > changes:
+                return True
+        return False
+
+    def set_tabled (self, module, name, arity, fn=None):
+        l = self.tabled.setdefault((name, arity), [])
+        if not (module, fn) in l:
+            l.append((module, fn))
+
+    def is_tabled (self, name, arity):
+        return (name, arity) in self.tabled
+
+    def _clear_tabled (self, f):
+        for key in list(self.tabled):
+            l = list(filter(lambda mf: not f(mf), self.tabled[key]))
+            if l:
+                self.tabled[key] = l
+            else:
+                del self.tabled[key]
+
+    def stats (self, name, arity):
+        return compute_stats(arity, self.lookup(name, arity))
+
+    def store_doc (self, module, name, doc, fn=None):
+        self.docs[name] = (module, doc, fn)
+
+    def retract_clauses (self, name, patterns):
+
+        if not name in self.clauses:
+            return 0
+
+        l = []
+        for mc in self.clauses[name]:
+            for p in patterns:
+                if _match_p(mc[1].head, p):
+                    break
+            else:
+                l.append(mc)
+
+        cnt = len(self.clauses[name]) - len(l)
+        if cnt:
+            self.clauses[name] = l
+            self.invalidate_cache(name)
+
+        return cnt
+
+    def preload (self, modules=None, predicates=None):
+        return 0
+
+    def start_query (self):
+        pass
+
+    def lookup_async (self, name, arity, overlay=None, sf=None, executor=None):
+
+        """ no i/o involved, the future returned is already completed """
+
+        import asyncio
+
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(self.lookup(name, arity, overlay=overlay, sf=sf))
+        return future
+
+    def gensym (self, root):
+
+        current_num = self.gensyms.get(root, 0) + 1
+        self.gensyms[root] = current_num
+
+        return root + str(current_num)
+
+    # use arity=-1 to disable filtering
+    # returns a read-only sequence of clauses (tuple or ClauseView)
+    def lookup (self, name, arity, overlay=None, sf=None):
+
+        ci = self.indexes.get(name)
+        if ci is None:
+            ci = ClauseIndex(name)
+            ci.set_clauses(map(lambda mc: mc[1], self.clauses.get(name, [])))
+            self.indexes[name] = ci
+
+        res = ci.lookup(arity, sf)
+
+        if overlay:
+            res = overlay.do_filter(name, res, arity, sf)
+
+        return res
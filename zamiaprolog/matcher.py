@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2015, 2016, 2017 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# clause head matchers
+#
+# compile_head() turns a clause head into a closure which unifies the arguments
+# of a goal with it, equivalent to PrologRuntime._unify(goal, env, head, child_env)
+# minus the implicit overlay variable (handled by the caller). Each head argument
+# gets a specialized step depending on its kind (anonymous/first-occurrence
+# variable, atom, number or string), anything else - compound terms, repeated
+# and pseudo variables, lists - falls back to the generic _unify() for that argument.
+#
+# LogicDB compiles the heads of all clauses it caches (see compile_clauses).
+#
+# note: logic terms are old-style classes on python 2, so exact type checks
+# use __class__ rather than type().
+#
+
+from zamiaprolog.logic import *
+
+def _term_variables (t, names):
+
+    if isinstance(t, Variable):
+        names.add(t.name)
+    elif isinstance(t, Predicate):
+        for a in t.args:
+            _term_variables(a, names)
+    elif isinstance(t, ListLiteral):
+        for a in t.l:
+            _term_variables(a, names)
+
+def _step_anon (rt, s, env, denv, location):
+    return True
+
+def _step_generic (d):
+
+    def step (rt, s, env, denv, location):
+        return rt._unify (s, env, d, denv, location, False)
+
+    return step
+
+def _step_bind (d):
+
+    name = d.name
+
+    def step (rt, s, env, denv, location):
+
+        # plain values evaluate to themselves, bind them directly
+        t = s.__class__
+        if t is NumberLiteral or t is StringLiteral:
+            denv[name] = s
+            return True
+        if t is Predicate and not s.args and not (u':' in s.name) and not (s.name in rt.eval_names):
+            denv[name] = s
+            return True
+
+        return rt._unify (s, env, d, denv, location, False)
+
+    return step
+
+def _step_atom (d):
+
+    name = d.name
+
+    def step (rt, s, env, denv, location):
+        if s.__class__ is Predicate:
+            return s.name == name and not s.args
+        return rt._unify (s, env, d, denv, location, False)
+
+    return step
+
+def _step_literal (d):
+
+    def step (rt, s, env, denv, location):
+        t = s.__class__
+        if t is NumberLiteral or t is StringLiteral:
+            return s == d
+        if t is Predicate:
+            return False
+        return rt._unify (s, env, d, denv, location, False)
+
+    return step
+
+def compile_head (head):
+
+    """ returns a matcher function (rt, args, env, child_env, location) -> bool for clause head """
+
+    steps = []
+    bound = set()       # variables which may have been bound by earlier arguments
+
+    for i, d in enumerate(head.args):
+
+        if isinstance(d, Variable):
+            if d.name == u'_':
+                step = _step_anon
+            elif (u':' in d.name) or (d.name in bound):
+                step = _step_generic(d)
+            else:
+                step = _step_bind(d)
+                bound.add(d.name)
+
+        elif isinstance(d, Predicate) and not d.args and not (u':' in d.name):
+            step = _step_atom(d)
+
+        elif d.__class__ is NumberLiteral or d.__class__ is StringLiteral:
+            step = _step_literal(d)
+
+        else:
+            step = _step_generic(d)
+            _term_variables(d, bound)
+
+        steps.append((i, d, step))
+
+    steps = tuple(steps)
+
+    def matcher (rt, args, env, denv, location):
+
+        for i, d, step in steps:
+
+            s = args[i]
+
+            if s.__class__ is Variable:
+
+                if s.name == u'_':
+                    continue
+
+                if u':' in s.name:
+                    if not rt._unify (s, env, d, denv, location, False):
+                        return False
+                    continue
+
+                # resolve goal variable, unbound ones match anything
+                v = env.get(s.name)
+                if not v:
+                    continue
+                t = v.__class__
+                if t is NumberLiteral or t is StringLiteral:
+                    s = v
+                else:
+                    s = rt.prolog_eval(v, env, location)
+                    if isinstance(s, Variable):
+                        continue
+
+            if not step(rt, s, env, denv, location):
+                return False
+
+        return True
+
+    return matcher
+
+def compile_clauses (clauses):
+
+    """ attach head matchers to clauses (if not done yet), yields the clauses """
+
+    for clause in clauses:
+        if clause.matcher is None:
+            clause.matcher = compile_head(clause.head)
+        yield clause
+
@@ -20,7 +20,7 @@
 
 import sys
 
-from sqlalchemy import Column, Integer, String, Text, Unicode, UnicodeText, Enum, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Unicode, UnicodeText, Enum, DateTime, ForeignKey, LargeBinary, Index, func, cast
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -28,9 +28,17 @@ from nltools import misc
 
 Base = declarative_base()
 
+# number of leading head arguments whose functors are materialized in the arg<n> columns
+MATERIALIZED_ARGS = 3
+
+# clause positions: source files start at the (largest clause id at their first compilation) << POS_SHIFT,
+# clauses not compiled from a source file are positioned at their id << POS_SHIFT
+POS_SHIFT = 24
+
 class ORMClause(Base):
 
     __tablename__ = 'clauses'
+    __table_args__ = (Index('ix_clauses_head_arity', 'head', 'arity'), )
 
     id                = Column(Integer, primary_key=True)
 
@@ -38,7 +46,31 @@ class ORMClause(Base):
     head              = Column(String(255), index=True)
     arity             = Column(Integer, index=True) 
     prolog            = Column(Text)
+    prolog_bin        = Column(LargeBinary)   # compact encoding (see logic.prolog_to_bin), NULL -> use json
+
+    # head argument functors: atom name, name/arity for compound terms, NULL for variables and literals
+    arg0              = Column(String(255))
+    arg1              = Column(String(255))
+    arg2              = Column(String(255))
+
+    fn                = Column(String(255), index=True)   # source file the clause was compiled from, if any
+    pos               = Column(BigInteger)                 # position in source order, NULL: see clause_order
   
+# order clauses are returned in: source order of files, store order otherwise
+clause_order = func.coalesce(ORMClause.pos, cast(ORMClause.id, BigInteger) * (1 << POS_SHIFT))
+
+class ORMModulePredicate(Base):
+
+    # predicate names a module contributes clauses to, used for
+    # per-module cache invalidation. Duplicates are harmless.
+
+    __tablename__ = 'module_predicates'
+
+    id                = Column(Integer, primary_key=True)
+
+    module            = Column(String(255), index=True)
+    name              = Column(String(255))
+
 class ORMPredicateDoc(Base):
 
     __tablename__ = 'predicate_docs'
@@ -48,10 +80,61 @@ class ORMPredicateDoc(Base):
 
     doc               = Column(UnicodeText)
 
+    fn                = Column(String(255), index=True)   # source file the doc comment was compiled from, if any
+
+class ORMSourceFile(Base):
+
+    # per (module, file) record of the last compilation, see PrologParser.compile_file
+
+    __tablename__ = 'source_files'
+
+    module            = Column(String(255), primary_key=True)
+    fn                = Column(String(255), primary_key=True)
+
+    hash              = Column(String(64))
+    compiler_version  = Column(Integer)
+
+    pos               = Column(BigInteger)      # position of the file's clauses, kept across recompilations
+    deps              = Column(Text)            # json dict: hash per predicate inlined by the compilation
+
+class ORMTabledPredicate(Base):
+
+    # table/1 declarations, see tabling.table_directive
+
+    __tablename__ = 'tabled_predicates'
+
+    module            = Column(String(255), primary_key=True)
+    name              = Column(String(255), primary_key=True)
+    arity             = Column(Integer, primary_key=True)
+
+    fn                = Column(String(255), index=True)   # source file the declaration was compiled from, if any
+
+class ORMPredicateStats(Base):
+
+    # statistics per name/arity for query planning, see LogicDB.stats().
+    # rows are dropped whenever the predicate is written to and recomputed on demand.
+
+    __tablename__ = 'predicate_stats'
+
+    name              = Column(String(255), primary_key=True)
+    arity             = Column(Integer, primary_key=True)
+
+    clauses           = Column(Integer)
+    facts             = Column(Integer)
+    distinct          = Column(Text)            # json list: number of distinct bound values per argument position
+
 class ORMGensymNum(Base):
 
     __tablename__ = 'gensym_nums'
 
     root              = Column(String(255), primary_key=True)
-    current_num       = Column(Integer)
+    current_num       = Column(Integer)         # last number reserved (see LogicDB.gensym)
+
+class ORMGeneration(Base):
+
+    __tablename__ = 'generations'
+
+    name              = Column(String(255), primary_key=True)   # predicate name, GLOBAL_GENERATION holds the counter
+    generation        = Column(Integer, index=True)
 
+GLOBAL_GENERATION = u''
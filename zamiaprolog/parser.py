@@ -65,6 +65,7 @@ import sys
 import logging
 import codecs
 import re
+import hashlib
 
 from copy                import copy
 
@@ -73,8 +74,15 @@ from six                 import StringIO, text_type
 from zamiaprolog.logic   import *
 from zamiaprolog.errors  import *
 from zamiaprolog.runtime import PrologRuntime
+from zamiaprolog.logicdb import STORE_BATCH_SIZE
+from zamiaprolog.tabling import TABLE_DIRECTIVE, table_directive
 from nltools.tokenizer   import tokenize
 
+# recorded per compiled source file, bump whenever the compiled form of clauses
+# changes so compile_file() does not skip files compiled by an older version
+
+COMPILER_VERSION = 1
+
 # lexer
 
 NAME_CHARS = set([u'a',u'b',u'c',u'd',u'e',u'f',u'g',u'h',u'i',u'j',u'k',u'l',u'm',u'n',u'o',u'p',u'q',u'r',u's',u't',u'u',u'v',u'w',u'x',u'y',u'z',
@@ -168,6 +176,17 @@ class PrologParser(object):
         self.directives = {}
         self.db         = db 
         self.do_inline  = do_inline
+        self.rt         = PrologRuntime(db)     # unification of inlined predicates
+
+        self.register_directive(TABLE_DIRECTIVE, table_directive, None)
+
+        # compile_file() batch mode: clauses not written to the db yet
+        self.pending        = []
+        self.pending_module = None
+        self.pending_fn     = None
+        self.pending_pos    = None
+        self.batch_size     = 0
+        self.deps           = set()     # names of the predicates inlined
     
     def report_error(self, s):
         raise PrologError ("%s: error in line %d col %d: %s" % (self.prolog_fn, self.cur_line, self.cur_col, s))
@@ -725,6 +744,9 @@ class PrologParser(object):
 
             # see if we can find a clause that unifies with the pred to inline
 
+            self.flush_pending()
+
+            self.deps.add(pred.name)
             clauses   = self.db.lookup(pred.name, arity=-1)
             succeeded = None
             succ_bind = None
@@ -823,6 +845,7 @@ class PrologParser(object):
         # compiler directive?
 
         if c.head.name in self.directives:
+            self.flush_pending()
             f, user_data = self.directives[c.head.name]
             f(self.db, self.module_name, c, user_data)
 
@@ -875,24 +898,70 @@ class PrologParser(object):
     def clear_module (self, module_name):
         self.db.clear_module(module_name)
 
-    def compile_file (self, filename, module_name, clear_module=False):
+    def flush_pending (self):
+
+        """ write clauses buffered by compile_file() to the db """
+
+        if not self.pending:
+            return
+
+        self.db.store_many (self.pending_module, self.pending, batch_size=self.batch_size, fn=self.pending_fn, pos=self.pending_pos)
+        self.pending_pos += len(self.pending)
+        self.pending = []
+
+    def _dep_hashes (self, names):
+
+        """ hash of the clauses of each predicate in names """
+
+        return dict(map(lambda name: (name, hashlib.sha1(u'\n'.join(map(text_type, self.db.lookup(name, -1))).encode('utf8')).hexdigest()),
+                        names))
 
-        # quick source line count for progress output below
+    def compile_file (self, filename, module_name, clear_module=False, batch_size=STORE_BATCH_SIZE, force=False, incremental=False):
+
+        """ compile prolog source file into module_name. Clauses are buffered and bulk-inserted
+            batch_size at a time (see LogicDB.store_many), batch_size=0 stores them one by one.
+
+            A content hash and COMPILER_VERSION are recorded per (module, file). If incremental
+            is set, unchanged files are skipped (unless force is set) - unless predicates they
+            inline have changed. Directives of skipped files are not run, so only use it if
+            their effects are all kept in the db.
+            A recompiled file only replaces its own clauses, which keep their position relative
+            to clauses of other files (see LogicDB.get_source_pos).
+            If compilation fails, the db's uncommitted changes are rolled back.
+            Returns False if the file was skipped, True otherwise. """
 
-        self.linecnt = 1
         with codecs.open(filename, encoding='utf-8', errors='ignore', mode='r') as f:
-            while f.readline():
-                self.linecnt += 1
+            source = f.read()
+
+        self.linecnt = source.count(u'\n') + 1
         logging.info("%s: %d lines." % (filename, self.linecnt))
 
-        # remove old predicates of this module from db
-        if clear_module:
-            self.clear_module (module_name, db)
+        src_hash = hashlib.sha1(source.encode('utf8')).hexdigest()
 
-        # actual parsing starts here
+        if incremental and not force and not clear_module:
+            rec = self.db.get_source_file(module_name, filename)
+            if rec and rec[:2] == (src_hash, COMPILER_VERSION) and self._dep_hashes(rec[2]) == rec[2]:
+                logging.info("%s: unchanged, skipped." % filename)
+                return False
 
-        with codecs.open(filename, encoding='utf-8', errors='ignore', mode='r') as f:
-            self.start(f, filename, module_name=module_name, linecnt=self.linecnt)
+        try:
+
+            # remove old predicates of this module from db
+            if clear_module:
+                self.clear_module (module_name)
+            else:
+                self.db.clear_file (module_name, filename, commit=False)
+
+            # actual parsing starts here
+
+            self.pending        = []
+            self.pending_module = module_name
+            self.pending_fn     = filename
+            self.pending_pos    = self.db.get_source_pos(module_name, filename) + 1
+            self.batch_size     = batch_size
+            self.deps           = set()
+
+            self.start(StringIO(source), filename, module_name=module_name, linecnt=self.linecnt)
 
             while self.cur_sym != SYM_EOF:
                 clauses = self.clause()
@@ -900,16 +969,32 @@ class PrologParser(object):
                 for clause in clauses:
                     logging.debug(u"%7d / %7d (%3d%%) > %s" % (self.cur_line, self.linecnt, self.cur_line * 100 / self.linecnt, text_type(clause)))
 
-                    self.db.store (module_name, clause)
+                    if batch_size > 0:
+                        self.pending.append(clause)
+                        if len(self.pending) >= batch_size:
+                            self.flush_pending()
+                    else:
+                        self.db.store (module_name, clause, fn=filename, pos=self.pending_pos)
+                        self.pending_pos += 1
 
                 if self.comment_pred:
 
-                    self.db.store_doc (module_name, self.comment_pred, self.comment)
+                    self.db.store_doc (module_name, self.comment_pred, self.comment, fn=filename)
 
                     self.comment_pred = None
                     self.comment = ''
 
-        self.db.commit()
+            self.flush_pending()
+            self.db.set_source_file (module_name, filename, src_hash, COMPILER_VERSION, self._dep_hashes(self.deps))
+            self.db.commit()
+
+        except:
+            # do not leave a half-replaced module behind for the next commit
+            self.pending = []
+            self.db.rollback()
+            raise
 
         logging.info("Compilation succeeded.")
 
+        return True
+
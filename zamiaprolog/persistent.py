@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2015, 2016, 2017 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# persistent (immutable, structure-sharing) data structures
+#
+# PersistentMap is a hash array mapped trie: set() returns a new map which
+# shares all but the nodes on the path to the modified entry with the old one.
+#
+# cons lists are (head, tail) tuples, None is the empty list. They are built
+# newest element first, cons_to_tuple() returns the elements in insertion order.
+#
+
+_BITS      = 5
+_MASK      = (1 << _BITS) - 1
+_MAX_SHIFT = 30
+_HASH_MASK = 0xFFFFFFFF
+
+_MISSING   = object()
+
+def _hash (key):
+    return hash(key) & _HASH_MASK
+
+def _popcount (x):
+    return bin(x).count('1')
+
+def _replace (array, idx, entry):
+    return array[:idx] + (entry, ) + array[idx+1:]
+
+class _BitmapNode(object):
+
+    # array entries are either (key, value) leaf tuples or child nodes
+
+    __slots__ = ('bitmap', 'array')
+
+    def __init__(self, bitmap, array):
+        self.bitmap = bitmap
+        self.array  = array
+
+class _CollisionNode(object):
+
+    # keys with identical hashes
+
+    __slots__ = ('hash', 'pairs')
+
+    def __init__(self, h, pairs):
+        self.hash  = h
+        self.pairs = pairs
+
+_EMPTY_NODE = _BitmapNode(0, ())
+
+def _make_node (shift, h1, k1, v1, h2, k2, v2):
+
+    if h1 == h2:
+        return _CollisionNode(h1, ((k1, v1), (k2, v2)))
+
+    node, added = _assoc(_EMPTY_NODE, shift, h1, k1, v1)
+    node, added = _assoc(node, shift, h2, k2, v2)
+
+    return node
+
+def _assoc (node, shift, h, key, value):
+
+    """ returns new node, True if key was added (False if replaced) """
+
+    if isinstance(node, _CollisionNode):
+
+        if h == node.hash:
+            for idx, (k, v) in enumerate(node.pairs):
+                if k == key:
+                    return _CollisionNode(h, _replace(node.pairs, idx, (key, value))), False
+            return _CollisionNode(h, node.pairs + ((key, value), )), True
+
+        # different hash ending up here: push the collision node one level down
+        node = _BitmapNode(1 << ((node.hash >> shift) & _MASK), (node, ))
+
+    bit = 1 << ((h >> shift) & _MASK)
+    idx = _popcount(node.bitmap & (bit - 1))
+
+    if not (node.bitmap & bit):
+        return _BitmapNode(node.bitmap | bit, node.array[:idx] + ((key, value), ) + node.array[idx:]), True
+
+    entry = node.array[idx]
+
+    if isinstance(entry, tuple):
+
+        k, v = entry
+        if k == key:
+            return _BitmapNode(node.bitmap, _replace(node.array, idx, (key, value))), False
+
+        child = _make_node(shift + _BITS, _hash(k), k, v, h, key, value)
+        return _BitmapNode(node.bitmap, _replace(node.array, idx, child)), True
+
+    child, added = _assoc(entry, shift + _BITS, h, key, value)
+
+    return _BitmapNode(node.bitmap, _replace(node.array, idx, child)), added
+
+def _find (node, shift, h, key):
+
+    while True:
+
+        if isinstance(node, _CollisionNode):
+            if h == node.hash:
+                for k, v in node.pairs:
+                    if k == key:
+                        return v
+            return _MISSING
+
+        bit = 1 << ((h >> shift) & _MASK)
+        if not (node.bitmap & bit):
+            return _MISSING
+
+        entry = node.array[_popcount(node.bitmap & (bit - 1))]
+
+        if isinstance(entry, tuple):
+            if entry[0] == key:
+                return entry[1]
+            return _MISSING
+
+        node   = entry
+        shift += _BITS
+
+def _iter_items (node):
+
+    if isinstance(node, _CollisionNode):
+        for pair in node.pairs:
+            yield pair
+        return
+
+    for entry in node.array:
+        if isinstance(entry, tuple):
+            yield entry
+        else:
+            for pair in _iter_items(entry):
+                yield pair
+
+class PersistentMap(object):
+
+    """ immutable hash map, set() returns a modified copy in O(log n) """
+
+    __slots__ = ('root', 'count')
+
+    def __init__(self, root=_EMPTY_NODE, count=0):
+        self.root  = root
+        self.count = count
+
+    def get (self, key, default=None):
+        v = _find(self.root, 0, _hash(key), key)
+        if v is _MISSING:
+            return default
+        return v
+
+    def set (self, key, value):
+        root, added = _assoc(self.root, 0, _hash(key), key, value)
+        return PersistentMap(root, self.count + 1 if added else self.count)
+
+    def __getitem__ (self, key):
+        v = _find(self.root, 0, _hash(key), key)
+        if v is _MISSING:
+            raise KeyError(key)
+        return v
+
+    def __contains__ (self, key):
+        return _find(self.root, 0, _hash(key), key) is not _MISSING
+
+    def __len__ (self):
+        return self.count
+
+    def __iter__ (self):
+        for k, v in _iter_items(self.root):
+            yield k
+
+    def items (self):
+        return list(_iter_items(self.root))
+
+EMPTY_MAP = PersistentMap()
+
+def cons_iter (l):
+
+    """ iterate over cons list l, newest element first """
+
+    while l is not None:
+        yield l[0]
+        l = l[1]
+
+def cons_to_tuple (l):
+
+    """ elements of cons list l in insertion order """
+
+    res = list(cons_iter(l))
+    res.reverse()
+    return tuple(res)
+
+def cons_from (elements):
+
+    """ build a cons list from elements given in insertion order """
+
+    l = None
+    for e in elements:
+        l = (e, l)
+    return l
+
@@ -34,15 +34,25 @@ import codecs
 import re
 import copy
 import time
+import itertools
 
 from six                  import string_types
 from zamiaprolog.logic    import *
 from zamiaprolog.builtins import *
 from zamiaprolog.errors   import *
+from zamiaprolog.tabling  import TableStore, TableState, AnswerTable, variant_key
 from nltools.misc         import limit_str
 
 SLOW_QUERY_TS = 1.0
 
+# search_async() returns control to the event loop every ASYNC_YIELD_STEPS inference steps
+ASYNC_YIELD_STEPS = 100
+
+# requests yielded by the search core (see PrologRuntime._search_steps)
+SEARCH_LOOKUP = 0       # (SEARCH_LOOKUP, name, arity, overlay, sf), expects the clauses to be sent back
+SEARCH_YIELD  = 1       # (SEARCH_YIELD, ), search can be suspended here
+SEARCH_SOLUTION = 2     # (SEARCH_SOLUTION, env), a solution was found (stream mode only)
+
 def prolog_unary_plus  (a) : return NumberLiteral(a)
 def prolog_unary_minus (a) : return NumberLiteral(-a)
 
@@ -64,9 +74,71 @@ binary_operators = {'+'  : prolog_binary_add,
 
 builtin_specials = set(['cut', 'fail', 'not', 'or', 'and', 'is', 'set'])
 
+#
+# trail mode (see PrologRuntime(trail=True)): instead of copying envs whenever a goal
+# is resumed or spawns subgoals, envs are shared and every write is recorded on the
+# trail of the current search. Each stack entry remembers the trail height it was
+# pushed at, popping it undoes all bindings made since (undo-on-backtrack).
+#
+
+_UNBOUND = object()
+
+class BindingEnv(dict):
+
+    """ env whose writes are recorded on a trail, used in trail mode """
+
+    __slots__ = ('trail', )
+
+    def __init__(self, trail, bindings=None):
+        dict.__init__(self)
+        self.trail = trail
+        if bindings:
+            dict.update(self, bindings)
+
+    def __setitem__(self, k, v):
+        self.trail.append((self, k, dict.get(self, k, _UNBOUND)))
+        dict.__setitem__(self, k, v)
+
+    def __delitem__(self, k):
+        self.trail.append((self, k, dict.__getitem__(self, k)))
+        dict.__delitem__(self, k)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def __copy__(self):
+        return BindingEnv(self.trail, self)
+
+def undo_trail (trail, mark):
+
+    """ undo all bindings recorded after trail height mark """
+
+    while len(trail) > mark:
+        env, k, old = trail.pop()
+        if old is _UNBOUND:
+            dict.pop(env, k, None)
+        else:
+            dict.__setitem__(env, k, old)
+
+def _term_vars (term, res):
+
+    """ add the names of the variables occuring in term to res """
+
+    if isinstance(term, Variable):
+        res.add(term.name)
+
+    elif isinstance(term, Predicate):
+        for a in term.args:
+            _term_vars(a, res)
+
+    elif isinstance(term, ListLiteral):
+        for a in term.l:
+            _term_vars(a, res)
+
 class PrologGoal:
 
-    def __init__ (self, head, terms, parent=None, env={}, negate=False, inx=0, location=None) :
+    def __init__ (self, head, terms, parent=None, env={}, negate=False, inx=0, location=None, barrier=0) :
 
         assert type(terms) is list
         assert location
@@ -78,6 +150,14 @@ class PrologGoal:
         self.negate   = negate
         self.inx      = inx
         self.location = location
+        self.barrier  = barrier     # stack height at the time the clause was called, cut truncates to it
+
+        # trail mode: trail height at push time, bindings to apply once popped
+        self.mark     = 0
+        self.bindings = None
+
+        # last call frames: continuation resumed ahead of time (see PrologRuntime._last_call)
+        self.tail     = None
 
     def __unicode__ (self):
         
@@ -111,29 +191,56 @@ class PrologGoal:
 
 class PrologRuntime(object):
 
-    def register_builtin (self, name, builtin):
+    def register_builtin (self, name, builtin, readonly=False):
+
+        """ readonly: builtin never (re-)assigns variables passed to it, which allows last
+            call optimization of calls to predicates using it (see _last_call) """
+
         self.builtins[name] = builtin
+        if readonly:
+            self.readonly_builtins.add(name)
+        else:
+            self.readonly_builtins.discard(name)
 
     def register_builtin_function (self, name, fn):
         self.builtin_functions[name] = fn
+        self.eval_names.add(name)
 
     def set_trace(self, trace):
         self.trace = trace
 
-    def __init__(self, db):
+    def __init__(self, db, preload=False, trail=False, tables=None):
+
+        """ preload: warm up the db clause cache (see LogicDB.preload), True for all
+                     modules or a list of module names
+            trail: share envs between goals and undo bindings on backtracking instead of
+                   copying envs for every resumed goal, same solutions, less copying
+            tables: TableStore keeping the answer tables of tabled predicates across searches,
+                    defaults to one with the default limits. False: answer tables only
+                    last for the search computing them. """
+
         self.db                = db
         self.builtins          = {}
+        self.readonly_builtins = set()
         self.builtin_functions = {}
         self.trace             = False
+        self.use_trail         = trail
+        self.tables            = TableStore() if tables is None else (None if tables is False else tables)
+
+        # atoms prolog_eval() does not return as they are (see matcher.compile_head)
+        self.eval_names        = set(unary_operators) | set(binary_operators)
+
+        # name -> (may overwrite, names the result depends on, db changes count), see _overwrites
+        self.overwrites        = {}
 
         # arithmetic
 
-        self.register_builtin('>',               builtin_larger)
-        self.register_builtin('<',               builtin_smaller)
-        self.register_builtin('=<',              builtin_smaller_or_equal)
-        self.register_builtin('>=',              builtin_larger_or_equal)
-        self.register_builtin('\\=',             builtin_non_equal)
-        self.register_builtin('=',               builtin_equal)
+        self.register_builtin('>',               builtin_larger, readonly=True)
+        self.register_builtin('<',               builtin_smaller, readonly=True)
+        self.register_builtin('=<',              builtin_smaller_or_equal, readonly=True)
+        self.register_builtin('>=',              builtin_larger_or_equal, readonly=True)
+        self.register_builtin('\\=',             builtin_non_equal, readonly=True)
+        self.register_builtin('=',               builtin_equal, readonly=True)
 
         self.register_builtin('increment',       builtin_increment) # increment (?V, +I)
         self.register_builtin('decrement',       builtin_decrement) # decrement (?V, +D)
@@ -154,17 +261,17 @@ class PrologRuntime(object):
 
         # I/O
 
-        self.register_builtin('write',           builtin_write)          # write (+Term)
-        self.register_builtin('nl',              builtin_nl)             # nl
+        self.register_builtin('write',           builtin_write, readonly=True)          # write (+Term)
+        self.register_builtin('nl',              builtin_nl, readonly=True)             # nl
 
         # debug, tracing, control
 
-        self.register_builtin('log',             builtin_log)            # log (+Level, +Terms...)
-        self.register_builtin('trace',           builtin_trace)          # trace (+OnOff)
-        self.register_builtin('true',            builtin_true)           # true
+        self.register_builtin('log',             builtin_log, readonly=True)            # log (+Level, +Terms...)
+        self.register_builtin('trace',           builtin_trace, readonly=True)          # trace (+OnOff)
+        self.register_builtin('true',            builtin_true, readonly=True)           # true
         self.register_builtin('ignore',          builtin_ignore)         # ignore (+P)
-        self.register_builtin('var',             builtin_var)            # var (+Term)
-        self.register_builtin('nonvar',          builtin_nonvar)         # nonvar (+Term)
+        self.register_builtin('var',             builtin_var, readonly=True)            # var (+Term)
+        self.register_builtin('nonvar',          builtin_nonvar, readonly=True)         # nonvar (+Term)
 
         # these have become specials now
         # self.register_builtin('is',              builtin_is)             # is (?Ques, +Ans)
@@ -172,7 +279,7 @@ class PrologRuntime(object):
 
         # lists
 
-        self.register_builtin('list_contains',   builtin_list_contains)
+        self.register_builtin('list_contains',   builtin_list_contains, readonly=True)
         self.register_builtin('list_nth',        builtin_list_nth)
         self.register_builtin('length',          builtin_length)         # length (+List, -Len)
         self.register_builtin('list_slice',      builtin_list_slice)     # list_slice (+Idx1, +Idx2, +List, -Slice) 
@@ -194,9 +301,9 @@ class PrologRuntime(object):
 
         # assert, rectract...
 
-        self.register_builtin('assertz',         builtin_assertz)        # assertz (+P)
-        self.register_builtin('retract',         builtin_retract)        # retract (+P)
-        self.register_builtin('setz',            builtin_setz)           # setz (+P, +V)
+        self.register_builtin('assertz',         builtin_assertz, readonly=True)        # assertz (+P)
+        self.register_builtin('retract',         builtin_retract, readonly=True)        # retract (+P)
+        self.register_builtin('setz',            builtin_setz, readonly=True)           # setz (+P, +V)
         self.register_builtin('gensym',          builtin_gensym)         # gensym (+Root, -Unique)
 
         #
@@ -215,6 +322,9 @@ class PrologRuntime(object):
         self.register_builtin_function ('list_slice', builtin_list_slice_fn)
         self.register_builtin_function ('list_join',  builtin_list_join_fn)
 
+        if preload:
+            self.db.preload(modules=None if preload is True else preload)
+
     def prolog_eval (self, term, env, location):      # eval all variables within a term to constants
 
         #
@@ -250,7 +360,7 @@ class PrologRuntime(object):
                 if not wildcard_found:
                     pattern.append('_1')
 
-                solutions = self.search_predicate (subparts[0], pattern, env=env)
+                solutions = self.search_predicate (subparts[0], pattern, env=env, limit=1)
                 if len(solutions)<1:
                     return Variable(term.name)
                 v = solutions[0]['_1']
@@ -548,7 +658,193 @@ class PrologRuntime(object):
         for k in sorted(env):
             logging.info(u"%s   %s=%s" % (indent, k, limit_str(repr(env[k]), 80)))
 
-    def _finish_goal (self, g, succeed, stack, solutions):
+    def _push (self, stack, goal, trail):
+        if trail is not None:
+            goal.mark = len(trail)
+        stack.append(goal)
+
+    def _sub_env (self, env, trail):
+
+        """ env for a goal resumed or spawned from a goal with env """
+
+        if trail is not None:
+            return env
+        return copy.copy(env)
+
+    def _unify_parent (self, g, parent, trail):
+
+        # trail mode: and/or/not subgoals share their parent's env, unifying the parent
+        # term with itself would just re-apply pseudo-variable assignments to the overlay
+
+        if trail is not None and parent.env is g.env and ASSERT_OVERLAY_VAR_NAME in g.env:
+            return
+
+        self._unify (g.head, g.env,
+                     parent.terms[parent.inx], parent.env, g.location, overwrite_vars = True)
+
+    def _copy_goal (self, goal, trail):
+
+        """ shallow copy of goal, used to resume it """
+
+        return PrologGoal (head     = goal.head, 
+                           terms    = goal.terms, 
+                           parent   = goal.parent, 
+                           env      = self._sub_env(goal.env, trail),
+                           negate   = goal.negate,
+                           inx      = goal.inx,
+                           location = goal.location,
+                           barrier  = goal.barrier)
+
+    def _resume_parent (self, g, trail):
+
+        """ copy of g's parent advanced to its next goal after g succeeded """
+
+        if g.parent.tail is not None:
+            # last call: the parent has been resumed ahead of time already, 
+            # all that is left to pass on is the overlay
+            parent = self._copy_goal (g.parent.tail, trail)
+            if ASSERT_OVERLAY_VAR_NAME in g.env:
+                parent.env[ASSERT_OVERLAY_VAR_NAME] = g.env[ASSERT_OVERLAY_VAR_NAME]
+            return parent
+
+        parent = self._copy_goal (g.parent, trail)
+        self._unify_parent (g, parent, trail)
+        parent.inx = parent.inx+1                       # advance to next goal in body
+        return parent
+
+    def _ground (self, term, env):
+
+        if isinstance(term, Variable):
+            if term.name == u'_':
+                return True
+            if u':' in term.name:
+                return False
+            v = env.get(term.name)
+            return v is not None and self._ground(v, {})
+
+        if isinstance(term, Predicate):
+            for a in term.args:
+                if not self._ground(a, env):
+                    return False
+            return True
+
+        if isinstance(term, ListLiteral):
+            for a in term.l:
+                if not self._ground(a, env):
+                    return False
+            return True
+
+        return True
+
+    def _writes_vars (self, term, names, deps, seen, overlay):
+
+        """ True if goal term may assign a new value to any of the variables names """
+
+        if not isinstance(term, Predicate):
+            return True
+
+        name = term.name
+
+        if name in ['and', 'or', 'not']:
+            for a in term.args:
+                if self._writes_vars(a, names, deps, seen, overlay):
+                    return True
+            return False
+
+        if name == 'set':
+            return len(term.args) > 0 and isinstance(term.args[0], Variable) and term.args[0].name in names
+
+        # is/2 only binds unbound variables
+        if name in ['cut', 'fail', 'is']:
+            return False
+
+        targs = set()
+        for a in term.args:
+            _term_vars(a, targs)
+        if not (targs & names):
+            return False
+
+        if name in self.builtins:
+            return not name in self.readonly_builtins
+
+        return self._pred_overwrites(name, deps, seen, overlay)
+
+    def _pred_overwrites (self, name, deps, seen, overlay):
+
+        m = self._overwrites_memo(name, overlay)
+        if m is not None:
+            deps.update(m[1])
+            return m[0]
+
+        if name in seen:
+            return False
+        seen.add(name)
+        deps.add(name)
+
+        for clause in self.db.lookup(name, -1, overlay=overlay):
+            if clause.body is None:
+                continue
+            names = set()
+            _term_vars(clause.head, names)
+            if self._writes_vars(clause.body, names, deps, seen, overlay):
+                return True
+
+        return False
+
+    def _overwrites_memo (self, name, overlay):
+        m = self.overwrites.get(name)
+        if m is None or self.db.changed_since(m[1], m[2]):
+            return None
+        if overlay is not None and (m[1] & overlay.get_names()):
+            return None
+        return m
+
+    def _overwrites (self, name, overlay):
+
+        """ True if a call of name may assign new values to (bound) variables passed to it:
+            results of builtins like list_append or increment and of set/2 flow back to
+            the caller's variables when the callee's head is unified with the call """
+
+        m = self._overwrites_memo(name, overlay)
+        if m is not None:
+            return m[0]
+
+        changes = self.db.changes
+        deps    = set()
+        res     = self._pred_overwrites(name, deps, set(), overlay)
+
+        if overlay is None or not (deps & overlay.get_names()):
+            self.overwrites[name] = (res, deps, changes)
+
+        return res
+
+    def _last_call (self, g, trail):
+
+        """ last call optimization: if g is about to call its last goal with ground arguments
+            and the callee does not assign new values to its arguments (see _overwrites),
+            the callee cannot change anything in g, so g and all ancestors which would finish
+            right after it can be resumed ahead of time. Returns a frame to use as parent
+            for the callee's clauses which refers to that continuation only, so the finished
+            frames can be collected (tail recursion runs in constant memory) - or None
+            if the call is not eligible. """
+
+        if g.inx != len(g.terms)-1 or not self._ground(g.terms[g.inx], g.env):
+            return None
+
+        if self._overwrites(g.terms[g.inx].name, g.env.get(ASSERT_OVERLAY_VAR_NAME)):
+            return None
+
+        cont = self._copy_goal (g, trail)
+        cont.inx = cont.inx+1
+        while cont.inx >= len(cont.terms) and not cont.negate and cont.parent is not None:
+            cont = self._resume_parent (cont, trail)
+
+        frame = PrologGoal (g.head, g.terms, env=g.env, inx=g.inx, location=g.location, barrier=g.barrier)
+        frame.tail = cont
+
+        return frame
+
+    def _finish_goal (self, g, succeed, stack, solutions, trail=None):
 
         while True:
 
@@ -558,21 +854,11 @@ class PrologRuntime(object):
                 self._trace ('SUCCESS ', g)
 
                 if g.parent == None :                   # Our original goal?
-                    solutions.append(g.env)             # Record solution
+                    solutions.append(g.env if trail is None else dict(g.env))   # Record solution
 
                 else: 
                     # stack up shallow copy of parent goal to resume
-                    parent = PrologGoal (head     = g.parent.head, 
-                                         terms    = g.parent.terms, 
-                                         parent   = g.parent.parent, 
-                                         env      = copy.copy(g.parent.env),
-                                         negate   = g.parent.negate,
-                                         inx      = g.parent.inx,
-                                         location = g.parent.location)
-                    self._unify (g.head, g.env,
-                                 parent.terms[parent.inx], parent.env, g.location, overwrite_vars = True)
-                    parent.inx = parent.inx+1           # advance to next goal in body
-                    stack.append(parent)                # put it on the stack
+                    self._push(stack, self._resume_parent(g, trail), trail)
 
                 break
 
@@ -582,17 +868,15 @@ class PrologRuntime(object):
                 if g.parent == None :                   # Our original goal?
                     break
 
+                elif g.parent.tail is not None:
+                    # last call: failure propagates to the continuation
+                    g       = g.parent.tail
+                    succeed = False
+
                 else: 
                     # prepare shallow copy of parent goal to resume
-                    parent = PrologGoal (head     = g.parent.head, 
-                                         terms    = g.parent.terms, 
-                                         parent   = g.parent.parent, 
-                                         env      = copy.copy(g.parent.env),
-                                         negate   = g.parent.negate,
-                                         inx      = g.parent.inx,
-                                         location = g.parent.location)
-                    self._unify (g.head, g.env,
-                                 parent.terms[parent.inx], parent.env, g.location, overwrite_vars = True)
+                    parent = self._copy_goal (g.parent, trail)
+                    self._unify_parent (g, parent, trail)
                     g       = parent
                     succeed = False
 
@@ -632,7 +916,7 @@ class PrologRuntime(object):
             if not wildcard_found:
                 pattern.append('_1')
 
-            solutions = self.search_predicate (subparts[0], pattern, env=env)
+            solutions = self.search_predicate (subparts[0], pattern, env=env, limit=1)
             if len(solutions)<1:
                 raise PrologRuntimeError(u'is: failed to match part "%s" of "%s".' % (part, unicode(arg_Var)), location)
             v = solutions[0]['_1']
@@ -726,10 +1010,21 @@ class PrologRuntime(object):
 
         return True
 
-    def search (self, a_clause, env={}):
+    def _search_steps (self, a_clause, env, solutions, yield_steps=0, stream=False, tstate=None):
+
+        """ search core: generator which appends solutions to the solutions list and yields
+            SEARCH_LOOKUP requests for db lookups - plus SEARCH_YIELD requests every yield_steps
+            inference steps if yield_steps > 0. In stream mode, solutions are yielded as
+            SEARCH_SOLUTION requests as soon as they are found instead.
+            Driven by search(), search_iter() and search_async().
+            tstate: TableState of the enclosing search when evaluating a tabled call """
 
         if a_clause.body is None:
-            return [{}]
+            if stream:
+                yield (SEARCH_SOLUTION, {})
+            else:
+                solutions.append({})
+            return
 
         if isinstance (a_clause.body, Predicate):
             if a_clause.body.name == 'and':
@@ -739,18 +1034,42 @@ class PrologRuntime(object):
         else:
             raise PrologRuntimeError (u'search: expected predicate in body, got "%s" !' % unicode(a_clause))
 
-        stack     = [ PrologGoal (a_clause.head, terms, env=copy.copy(env), location=a_clause.location) ]
-        solutions = []
+        self.db.start_query()
+
+        if tstate is None:
+            tstate = TableState()
+
+        trail     = [] if self.use_trail else None
+        env       = BindingEnv(trail, env) if self.use_trail else copy.copy(env)
+        stack     = [ PrologGoal (a_clause.head, terms, env=env, location=a_clause.location) ]
 
         ts_start  = time.time()
+        steps     = 0
 
         while stack :
+
+            if stream and solutions:
+                yield (SEARCH_SOLUTION, solutions.pop())
+
+            if yield_steps > 0:
+                steps += 1
+                if steps % yield_steps == 0:
+                    yield (SEARCH_YIELD, )
+
             g = stack.pop()                         # Next goal to consider
 
+            if trail is not None:
+                undo_trail(trail, g.mark)           # backtrack
+                if g.bindings:
+                    g.env.update(g.bindings)
+                    g.bindings = None
+                if not stack:                       # no choicepoints left, nothing will be undone
+                    del trail[:]
+
             self._trace ('CONSIDER', g)
 
             if g.inx >= len(g.terms) :              # Is this one finished?
-                self._finish_goal (g, True, stack, solutions)
+                self._finish_goal (g, True, stack, solutions, trail)
                 continue
 
             # No. more to do with this goal.
@@ -768,21 +1087,19 @@ class PrologRuntime(object):
 
                 if name == 'cut':                   # zap the competition for the current goal
 
-                    # logging.debug ("CUT: stack before %s" % repr(stack))
-                    # import pdb; pdb.set_trace()
-
-                    while len(stack)>0 and stack[len(stack)-1].head and stack[len(stack)-1].head.name == g.parent.head.name:
-                        stack.pop()
+                    # drop all choicepoints created since the clause was called: alternative
+                    # clauses as well as pending solutions of goals before the cut
 
-                    # logging.debug ("CUT: stack after %s" % repr(stack))
+                    del stack[g.barrier:]
 
                 elif name == 'fail':            # Dont succeed
-                    self._finish_goal (g, False, stack, solutions)
+                    self._finish_goal (g, False, stack, solutions, trail)
                     continue
 
                 elif name == 'not':
                     # insert negated sub-guoal
-                    stack.append(PrologGoal(pred, pred.args, g, env=copy.copy(g.env), negate=True, location=g.location))
+                    # not/1 is opaque to cut
+                    self._push(stack, PrologGoal(pred, pred.args, g, env=self._sub_env(g.env, trail), negate=True, location=g.location, barrier=len(stack)), trail)
                     continue
 
                 elif name == 'or':
@@ -791,29 +1108,29 @@ class PrologRuntime(object):
 
                     # import pdb; pdb.set_trace()
                     for subgoal in reversed(pred.args):
-                        or_subg = PrologGoal(pred, [subgoal], g, env=copy.copy(g.env), location=g.location)
+                        or_subg = PrologGoal(pred, [subgoal], g, env=self._sub_env(g.env, trail), location=g.location, barrier=g.barrier)
                         self._trace ('  OR', or_subg)
                         # logging.debug ('    subgoal: %s' % subgoal)
-                        stack.append(or_subg)
+                        self._push(stack, or_subg, trail)
 
                     continue
 
                 elif name == 'and':
-                    stack.append(PrologGoal(pred, pred.args, g, env=copy.copy(g.env), location=g.location))
+                    self._push(stack, PrologGoal(pred, pred.args, g, env=self._sub_env(g.env, trail), location=g.location, barrier=g.barrier), trail)
                     continue
 
                 elif name == 'is':
                     if not (self._special_is (g)):
-                        self._finish_goal (g, False, stack, solutions)
+                        self._finish_goal (g, False, stack, solutions, trail)
                         continue
 
                 elif name == 'set':
                     if not (self._special_set (g)):
-                        self._finish_goal (g, False, stack, solutions)
+                        self._finish_goal (g, False, stack, solutions, trail)
                         continue
 
                 g.inx = g.inx + 1               # Succeed. resume self.
-                stack.append(g)
+                self._push(stack, g, trail)
                 continue
 
             # builtin predicate ?
@@ -828,15 +1145,21 @@ class PrologRuntime(object):
                     if type(bindings) is list:
 
                         for b in reversed(bindings):
-                            new_env = copy.copy(g.env)
-                            new_env.update(b)
-                            stack.append(PrologGoal(g.head, g.terms, parent=g.parent, env=new_env, inx=g.inx, location=g.location))
+                            if trail is not None:
+                                # bindings are applied once the goal is popped (after backtracking)
+                                bg = PrologGoal(g.head, g.terms, parent=g.parent, env=g.env, inx=g.inx, location=g.location, barrier=g.barrier)
+                                bg.bindings = b
+                                self._push(stack, bg, trail)
+                            else:
+                                new_env = copy.copy(g.env)
+                                new_env.update(b)
+                                stack.append(PrologGoal(g.head, g.terms, parent=g.parent, env=new_env, inx=g.inx, location=g.location, barrier=g.barrier))
 
                     else:
-                        stack.append(g)
+                        self._push(stack, g, trail)
 
                 else:
-                    self._finish_goal (g, False, stack, solutions)
+                    self._finish_goal (g, False, stack, solutions, trail)
 
                 continue
 
@@ -850,7 +1173,21 @@ class PrologRuntime(object):
             # if len(static_filter)>0:
             # if pred.name == 'not_dog':
             #     import pdb; pdb.set_trace()
-            clauses = self.db.lookup(pred.name, len(pred.args), overlay=g.env.get(ASSERT_OVERLAY_VAR_NAME), sf=static_filter)
+            if self.db.is_tabled(pred.name, len(pred.args)):
+
+                # answers from the table, evaluating it may take any number of db requests
+
+                clauses = []
+                tsteps  = self._table_steps(pred, g, static_filter, tstate, clauses)
+                try:
+                    req = next(tsteps)
+                    while True:
+                        req = tsteps.send((yield req))
+                except StopIteration:
+                    pass
+
+            else:
+                clauses = yield (SEARCH_LOOKUP, pred.name, len(pred.args), g.env.get(ASSERT_OVERLAY_VAR_NAME), static_filter)
 
             # if len(clauses) == 0: 
             #     # fail
@@ -858,6 +1195,11 @@ class PrologRuntime(object):
             #     continue
 
             success = False
+            barrier = len(stack)
+
+            # has to happen before the children are pushed (trail mode: their marks
+            # have to include the bindings made while resuming the continuation)
+            parent  = (self._last_call (g, trail) or g) if clauses else g
 
             for clause in reversed(clauses):
 
@@ -868,20 +1210,30 @@ class PrologRuntime(object):
 
                 # stack up child subgoal
 
+                child_env = {} if trail is None else BindingEnv(trail)
+
                 if clause.body:
-                    child = PrologGoal(clause.head, [clause.body], g, env={}, location=clause.location)
+                    child = PrologGoal(clause.head, [clause.body], parent, env=child_env, location=clause.location, barrier=barrier)
                 else:
-                    child = PrologGoal(clause.head, [], g, env={}, location=clause.location)
+                    child = PrologGoal(clause.head, [], parent, env=child_env, location=clause.location, barrier=barrier)
 
-                ans = self._unify (pred, g.env, clause.head, child.env, g.location, overwrite_vars = False)
+                if clause.matcher:
+                    ans = clause.matcher (self, pred.args, g.env, child.env, g.location)
+                    if ans and ASSERT_OVERLAY_VAR_NAME in g.env:
+                        child.env[ASSERT_OVERLAY_VAR_NAME] = g.env[ASSERT_OVERLAY_VAR_NAME]
+                else:
+                    ans = self._unify (pred, g.env, clause.head, child.env, g.location, overwrite_vars = False)
                 if ans:                             # if unifies, stack it up
-                    stack.append(child)
+                    self._push(stack, child, trail)
                     success = True
                     # logging.debug ("Queue %s" % str(child))
 
             if not success:
                 # make sure we explicitly fail for proper negation support
-                self._finish_goal (g, False, stack, solutions)
+                self._finish_goal (g, False, stack, solutions, trail)
+
+        if stream and solutions:
+            yield (SEARCH_SOLUTION, solutions.pop())
 
         # profiling 
         ts_delay = time.time() - ts_start
@@ -890,9 +1242,247 @@ class PrologRuntime(object):
             logging.warn (u'runtime: SLOW search for %s took %fs.' % (unicode(a_clause), ts_delay))
             # import pdb; pdb.set_trace()
 
+    def _complete_table (self, key, ovl, tstate):
+
+        # tables computed without overlay hold under any overlay which does not
+        # modify the predicates they depend on
+
+        keys = [ (None, key) ]
+        if ovl is not None:
+            keys.append((ovl.version, key))
+
+        for k in keys:
+
+            table = tstate.complete.get(k)
+            if table is None and self.tables is not None:
+                table = self.tables.get(k, self.db)
+            if table is None:
+                continue
+
+            if k[0] is None and ovl is not None and (table.deps & ovl.get_names()):
+                continue
+
+            return table
+
+        return None
+
+    def _store_table (self, tkey, table, tstate):
+
+        ovl = table.overlay
+        table.overlay = None
+
+        if ovl is not None and not (table.deps & ovl.get_names()):
+            tkey = (None, tkey[1])
+
+        tstate.complete[tkey] = table
+        if self.tables is not None:
+            self.tables.put(tkey, table)
+
+    def _table_steps (self, pred, g, sf, tstate, res):
+
+        """ tabled call pred in goal g: appends the answer clauses from its table to res.
+            Generator yielding the db requests needed to evaluate the table (see tabling) """
+
+        call = Predicate(pred.name, list(map(lambda a: self.prolog_eval(a, g.env, g.location), pred.args)))
+        ovl  = g.env.get(ASSERT_OVERLAY_VAR_NAME)
+        key  = variant_key(call)
+
+        table = self._complete_table(key, ovl, tstate)
+        if table is not None:
+            if tstate.stack:
+                tstate.stack[-1].deps.update(table.deps)
+            res.extend(table.clauses)
+            return
+
+        tkey  = (ovl.version if ovl is not None else None, key)
+        table = tstate.incomplete.get(tkey)
+
+        if table is not None and table.evaluating:
+            # recursive variant call: consume the answers found so far,
+            # the table's evaluation iterates until there are no new ones
+            top = tstate.stack[-1]
+            top.dep = min(top.dep, table.index)
+            res.extend(table.clauses)
+            return
+
+        if table is None:
+            table = AnswerTable(key, g.location)
+            table.changes = self.db.changes
+            table.overlay = ovl
+            tstate.incomplete[tkey] = table
+
+        table.evaluating = True
+        table.index      = len(tstate.stack)
+        table.serial     = tstate.serial
+        tstate.serial   += 1
+        tstate.stack.append(table)
+
+        while True:
+
+            table.dep = table.index
+            answers   = tstate.answers
+
+            clauses = yield (SEARCH_LOOKUP, pred.name, len(pred.args), ovl, sf)
+            table.deps.add(pred.name)
+
+            for clause in clauses:
+
+                if len(clause.head.args) != len(call.args): 
+                    continue
+
+                env = {}
+                if ovl is not None:
+                    env[ASSERT_OVERLAY_VAR_NAME] = ovl
+
+                if not self._unify (call, {}, clause.head, env, g.location, overwrite_vars = False):
+                    continue
+
+                if clause.body is None:
+                    solutions = [ env ]
+                else:
+                    solutions = []
+                    steps     = self._search_steps(Clause(None, clause.body, location=clause.location), env, solutions, tstate=tstate)
+                    try:
+                        req = next(steps)
+                        while True:
+                            if req[0] == SEARCH_LOOKUP:
+                                table.deps.add(req[1])
+                            req = steps.send((yield req))
+                    except StopIteration:
+                        pass
+
+                for s in solutions:
+                    answer = Predicate(call.name, list(map(lambda a: self.prolog_eval(a, s, clause.location), clause.head.args)))
+                    if table.add(answer):
+                        tstate.answers += 1
+
+            # depends on an older evaluation which will iterate, or fixpoint reached?
+            if table.dep < table.index or tstate.answers == answers:
+                break
+
+        tstate.stack.pop()
+        table.evaluating = False
+
+        if tstate.stack:
+            parent = tstate.stack[-1]
+            parent.deps.update(table.deps)
+            parent.dep = min(parent.dep, table.dep)
+
+        if table.dep >= table.index:
+
+            # leader: complete the tables evaluated on top of it along with it
+
+            for k, t in list(tstate.incomplete.items()):
+                if t.serial < table.serial:
+                    continue
+                del tstate.incomplete[k]
+                t.deps    = table.deps
+                t.changes = table.changes
+                self._store_table (k, t, tstate)
+
+        res.extend(table.clauses)
+
+    def search (self, a_clause, env={}, limit=None):
+
+        """ list of solution envs for a_clause, at most limit if given (search stops then) """
+
+        if limit is not None:
+            return list(itertools.islice(self.search_iter(a_clause, env), limit))
+
+        solutions = []
+        steps     = self._search_steps(a_clause, env, solutions)
+
+        try:
+            req = next(steps)
+            while True:
+                if req[0] == SEARCH_LOOKUP:
+                    req = steps.send(self.db.lookup(req[1], req[2], overlay=req[3], sf=req[4]))
+                else:
+                    req = next(steps)
+        except StopIteration:
+            pass
+
         return solutions
 
-    def search_predicate(self, name, args, env={}, location=None):
+    def search_iter (self, a_clause, env={}):
+
+        """ generator variant of search(): yields each solution env as soon as it is found,
+            the search only proceeds as far as the caller consumes solutions """
+
+        steps = self._search_steps(a_clause, env, [], stream=True)
+
+        try:
+            req = next(steps)
+            while True:
+                if req[0] == SEARCH_LOOKUP:
+                    req = steps.send(self.db.lookup(req[1], req[2], overlay=req[3], sf=req[4]))
+                elif req[0] == SEARCH_SOLUTION:
+                    yield req[1]
+                    req = next(steps)
+                else:
+                    req = next(steps)
+        except StopIteration:
+            pass
+        finally:
+            steps.close()
+
+    def search_async (self, a_clause, env={}, yield_steps=ASYNC_YIELD_STEPS, executor=None):
+
+        """ asyncio variant of search(): returns a future resolving to the list of solutions,
+            use as solutions = await rt.search_async(clause).
+
+            db lookups which cannot be answered from the clause cache run in executor (see
+            LogicDB.lookup_async), control returns to the event loop every yield_steps
+            inference steps. """
+
+        import asyncio
+
+        loop      = asyncio.get_event_loop()
+        future    = loop.create_future()
+        solutions = []
+        steps     = self._search_steps(a_clause, env, solutions, yield_steps=yield_steps)
+
+        def step(value=None):
+
+            if future.cancelled():
+                steps.close()
+                return
+
+            try:
+                req = steps.send(value)
+                while True:
+
+                    if req[0] == SEARCH_YIELD:
+                        loop.call_soon(step)
+                        return
+
+                    f = self.db.lookup_async(req[1], req[2], overlay=req[3], sf=req[4], executor=executor)
+                    if not f.done():
+                        f.add_done_callback(resume)
+                        return
+                    req = steps.send(f.result())
+
+            except StopIteration:
+                future.set_result(solutions)
+            except Exception as e:
+                future.set_exception(e)
+
+        def resume(f):
+            try:
+                clauses = f.result()
+            except Exception as e:
+                steps.close()
+                if not future.cancelled():
+                    future.set_exception(e)
+                return
+            step(clauses)
+
+        loop.call_soon(step)
+
+        return future
+
+
+    def search_predicate(self, name, args, env={}, location=None, limit=None):
 
         """ convenience function: build Clause/Predicate structure, translate python strings in args
             into Predicates/Variables by Prolog conventions (lowercase: predicate, uppercase: variable) """
@@ -900,7 +1490,7 @@ class PrologRuntime(object):
         if not location:
             location = SourceLocation('<input>', 0, 0)
 
-        solutions = self.search(Clause(body=build_predicate(name, args), location=location), env=env)
+        solutions = self.search(Clause(body=build_predicate(name, args), location=location), env=env, limit=limit)
 
         return solutions
 
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2015, 2016, 2017 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# read-only knowledge base snapshots
+#
+# file layout:
+#
+#   header  : magic 'ZPS', version byte, offset of the index (uint64),
+#             db generation at export time (uint64)
+#   blocks  : one block per predicate name/arity, clauses in db order:
+#             position (uint64), length (uint32), binary clause (see logic.prolog_to_bin)
+#   index   : json list of [name, arity, offset, size, count, [modules]]
+#
+# snapshots are opened via mmap so forked workers share the pages through
+# the os page cache, clauses are only decoded when a predicate is looked up.
+# LogicDB reads predicates modified in the db after the export generation
+# from the db instead.
+#
+
+import os
+import mmap
+import json
+import struct
+import logging
+import time
+
+from zamiaprolog         import model
+from zamiaprolog.logic   import *
+from zamiaprolog.errors  import PrologError
+
+SNAPSHOT_MAGIC   = b'ZPS'
+SNAPSHOT_VERSION = 3
+
+_HEADER = struct.Struct('>3sBQQ')
+_RECORD = struct.Struct('>QI')
+
+def export_snapshot (session, path, modules=None):
+
+    """ write clauses of the given modules (default: all) to snapshot file path,
+        returns the number of clauses written. Predicates are exported as a whole,
+        including clauses other modules contribute to them. """
+
+    ts_start = time.time()
+
+    # read before the clauses: commits in between make us claim an older
+    # generation than the clauses have, which only causes extra db reads
+
+    generation = session.query(model.ORMGeneration.generation).filter(model.ORMGeneration.name==model.GLOBAL_GENERATION).scalar() or 0
+
+    query = session.query(model.ORMClause)
+    if modules is not None:
+        heads = session.query(model.ORMClause.head).filter(model.ORMClause.module.in_(list(modules)))
+        query = query.filter(model.ORMClause.head.in_(heads.subquery()))
+    query = query.order_by(model.ORMClause.head, model.ORMClause.arity, model.clause_order, model.ORMClause.id)
+
+    index = []
+    cnt   = 0
+
+    # write to a temp file first so readers never see a partial snapshot
+
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+
+    with open(tmp_path, 'wb') as f:
+
+        f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, generation))
+
+        entry = None
+        for ormc in query.yield_per(1000):
+
+            if entry is None or entry[0] != ormc.head or entry[1] != ormc.arity:
+                entry = [ormc.head, ormc.arity, f.tell(), 0, 0, []]
+                index.append(entry)
+
+            if ormc.prolog_bin:
+                data = bytes(ormc.prolog_bin)
+            else:
+                data = prolog_to_bin(json_to_prolog(ormc.prolog))
+
+            # the position keeps the db order across arities for arity -1 lookups
+            pos = ormc.pos if ormc.pos is not None else ormc.id << model.POS_SHIFT
+            f.write(_RECORD.pack(pos, len(data)))
+            f.write(data)
+
+            entry[3] = f.tell() - entry[2]
+            entry[4] += 1
+            if not ormc.module in entry[5]:
+                entry[5].append(ormc.module)
+            cnt += 1
+
+        index_offset = f.tell()
+        f.write(json.dumps(index).encode('utf8'))
+
+        f.seek(0)
+        f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, index_offset, generation))
+
+    os.rename(tmp_path, path)
+
+    logging.info ('snapshot %s: %d clauses, %d predicates (generation %d) written in %fs' % (path, cnt, len(index), generation, time.time() - ts_start))
+
+    return cnt
+
+class Snapshot(object):
+
+    """ read-only view on a snapshot file """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = _HEADER.unpack(self.mm[:_HEADER.size])[:2]
+        if magic != SNAPSHOT_MAGIC:
+            raise PrologError('%s: not a snapshot file.' % path)
+        if version != SNAPSHOT_VERSION:
+            raise PrologError('%s: unsupported snapshot version %d, please re-export it.' % (path, version))
+
+        magic, version, index_offset, self.generation = _HEADER.unpack(self.mm[:_HEADER.size])
+
+        self.index = {}     # name -> {arity: (offset, size, count)}
+        self.modules = {}   # name -> set of modules
+
+        for name, arity, offset, size, count, modules in json.loads(self.mm[index_offset:].decode('utf8')):
+            self.index.setdefault(name, {})[arity] = (offset, size, count)
+            self.modules.setdefault(name, set()).update(modules)
+
+    def close(self):
+        self.mm.close()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get_names (self, module=None):
+        if module is None:
+            return list(self.index)
+        return list(filter(lambda name: module in self.modules[name], self.index))
+
+    def _records (self, offset, size):
+
+        mm  = self.mm
+        pos = offset
+        end = offset + size
+
+        while pos < end:
+            seq, l = _RECORD.unpack(mm[pos:pos+_RECORD.size])
+            pos += _RECORD.size
+            yield seq, mm[pos:pos+l]
+            pos += l
+
+    def load (self, name, arity=-1):
+
+        """ decode clauses of name/arity, all arities in db order for arity=-1 """
+
+        arities = self.index.get(name, {})
+
+        if arity >= 0:
+            if not arity in arities:
+                return []
+            offset, size, count = arities[arity]
+            return list(map(lambda r: bin_to_prolog(r[1]), self._records(offset, size)))
+
+        records = []
+        for offset, size, count in arities.values():
+            records.extend(self._records(offset, size))
+        records.sort(key=lambda r: r[0])
+
+        return list(map(lambda r: bin_to_prolog(r[1]), records))
+
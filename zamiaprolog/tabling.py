@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright 2015, 2016, 2017 Guenter Bartsch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# tabling: memoized answer tables for predicates declared via
+#
+#     table(name/arity, ...).
+#
+# Calls to tabled predicates are answered from a table keyed by the variant
+# of the call (the call with its variables renamed in order of occurrence).
+# A missing table is computed by PrologRuntime by resolving the call against
+# the predicate's clauses until no new answers turn up: recursive calls of
+# variants under evaluation consume the answers found so far, which makes
+# left recursion terminate. Tables depending on each other are completed
+# together by the oldest of them (its leader).
+#
+# Complete tables are kept in a TableStore across searches. Each table records
+# the predicates its evaluation looked up, it is dropped once the db reports
+# one of them as modified (LogicDB.changed_since). Under an overlay, a table is
+# keyed by the overlay version unless the overlay does not touch its predicates.
+#
+# limitations: side effects (assertz, ...) inside tabled predicates do not make
+# it into the answers, cut only prunes within a single clause of a tabled predicate.
+#
+
+from six                     import text_type
+from zamiaprolog.logic       import *
+from zamiaprolog.errors      import PrologError
+from zamiaprolog.matcher     import compile_head
+from zamiaprolog.clausecache import ClauseCache
+
+TABLE_DIRECTIVE     = 'table'
+
+TABLE_MAX_TABLES    = 10000
+TABLE_MAX_ANSWERS   = 1000000
+
+def table_directive(db, module_name, clause, user_data):
+
+    """ table (+Name/Arity, ...) compile directive """
+
+    for a in clause.head.args:
+
+        if not isinstance(a, Predicate) or a.name != u'/' or len(a.args) != 2 \
+           or not isinstance(a.args[0], Predicate) or a.args[0].args \
+           or not isinstance(a.args[1], NumberLiteral):
+            raise PrologError (u'table: name/arity expected, got %s' % text_type(a), clause.location)
+
+        db.set_tabled(module_name, a.args[0].name, int(a.args[1].f), clause.location.fn if clause.location else None)
+
+def _rename_vars (t, names):
+
+    if isinstance(t, Variable):
+        if t.name == u'_':
+            v = Variable(u'_T%d' % len(names))
+            names[object()] = v
+            return v
+        v = names.get(t.name)
+        if v is None:
+            v = Variable(u'_T%d' % len(names))
+            names[t.name] = v
+        return v
+
+    if isinstance(t, Predicate):
+        return Predicate(t.name, list(map(lambda a: _rename_vars(a, names), t.args)))
+
+    if isinstance(t, ListLiteral):
+        return ListLiteral(list(map(lambda a: _rename_vars(a, names), t.l)))
+
+    return t
+
+def variant_key (term):
+
+    """ key identifying term up to variable renaming """
+
+    return text_type(_rename_vars(term, {}))
+
+class AnswerTable(object):
+
+    """ answers of one variant call, as fact clauses """
+
+    def __init__(self, key, location):
+
+        self.key      = key
+        self.location = location
+        self.clauses  = []
+        self.answers  = set()       # variant keys of the answers
+        self.deps     = set()       # names of the predicates the answers depend on
+        self.changes  = 0           # db changes count at the start of the evaluation
+
+        # evaluation state (see PrologRuntime._table_steps)
+        self.overlay    = None      # overlay the table is evaluated under
+        self.evaluating = False
+        self.index      = 0         # position on the evaluation stack
+        self.serial     = 0         # evaluation order, tables evaluated after their leader are completed with it
+        self.dep        = 0         # oldest evaluation the current pass consumed answers of
+
+    def add (self, answer):
+
+        """ add answer (predicate), returns False if it is known already """
+
+        key = variant_key(answer)
+        if key in self.answers:
+            return False
+
+        self.answers.add(key)
+
+        clause = Clause(answer, location=self.location)
+        clause.matcher = compile_head(answer)
+        self.clauses.append(clause)
+
+        return True
+
+class TableState(object):
+
+    """ tables of a search (and the searches it nests) """
+
+    def __init__(self):
+        self.complete   = {}        # (overlay version, key) -> AnswerTable
+        self.incomplete = {}        # (overlay version, key) -> AnswerTable
+        self.stack      = []        # evaluation stack
+        self.serial     = 0         # number of evaluations started
+        self.answers    = 0         # number of answers added, to detect the fixpoint
+
+class TableStore(ClauseCache):
+
+    """ complete answer tables kept across searches, LRU eviction once either
+        max_tables or max_answers (total number of answers) is exceeded.
+        None disables the respective limit. """
+
+    def __init__(self, max_tables=TABLE_MAX_TABLES, max_answers=TABLE_MAX_ANSWERS):
+
+        super(TableStore, self).__init__(max_clauses=max_answers, max_entries=max_tables)
+
+    def get_stats(self):
+        return {'hits'         : self.hits,
+                'misses'       : self.misses,
+                'evictions'    : self.evictions,
+                'invalidations': self.invalidations,
+                'tables'       : len(self.entries),
+                'answers'      : self.clauses}
+
+    def get(self, key, db):
+
+        """ table stored for key if it is still valid with respect to db """
+
+        table = self.peek(key)
+        if table is None:
+            self.miss()
+            return None
+
+        if db.changed_since(table.deps, table.changes):
+            self.invalidate(key)
+            self.miss()
+            return None
+
+        self.hit(key)
+
+        return table
+
+    def put(self, key, table):
+        super(TableStore, self).put(key, table, len(table.clauses), 0)